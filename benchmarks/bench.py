@@ -0,0 +1,561 @@
+'''
+    bench.py
+
+    Benchmarks for the embed and copy generators and the markdeep verb,
+    runnable without a fips checkout or build: genutil and fips' 'mod'
+    package are replaced by minimal stubs.
+
+    Usage:
+
+        python benchmarks/bench.py run [--scale quick|full] [--only embed,copy,markdeep]
+                                       [--copy-modes copy,hardlink,reflink,auto]
+                                       [--repeat N] [--work-dir DIR] [--out FILE]
+                                       [--baseline FILE] [--threshold PERCENT]
+        python benchmarks/bench.py compare NEW.json BASELINE.json [--threshold PERCENT]
+        python benchmarks/bench.py embed-format [--sizes 1KB,1MB,64MB] [--repeat N]
+
+    Synthetic workloads are created in the work directory (a temporary
+    directory by default):
+
+    - embed-[size]: a single binary file, from KBs up to hundreds of MBs
+    - copy-[num]-[mode]: an asset tree of 10k (or 100k) small files,
+      deployed with each of the 'copy', 'hardlink', 'reflink' and 'auto'
+      modes (modes which aren't supported by the filesystem of the work
+      directory are skipped)
+    - markdeep-[num]: a header tree in which 10% of the headers have
+      /*# #*/ documentation blocks
+
+    Each workload is measured in three phases:
+
+    - cold: outputs and caches removed
+    - warm: caches present, but some inputs changed (all of the
+      embedded file, 1% of the assets or headers)
+    - noop: nothing changed since the last run
+
+    Each phase runs in a fresh child process, for the time (median of
+    --repeat runs), throughput and the peak RSS of that process. Results
+    are written as JSON, and compared against a baseline JSON file:
+    a phase regressed if its time or peak memory grew by more than the
+    threshold (and the time by more than --min-time seconds, to ignore
+    noise in very fast phases). A regression gives an exit code of 1.
+
+    'embed-format' compares the throughput of embed's chunked array
+    encoder (write_bytes) with the original per-byte write loop on random
+    data, and checks that both produce identical output. The original
+    loop only manages a few MB/s, so the 64 MB input takes tens of seconds.
+'''
+
+import os
+import sys
+import glob
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import filecmp
+import platform
+import tempfile
+import contextlib
+import subprocess
+import importlib.util
+
+RootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GeneratorsDir = os.path.join(RootDir, 'fips-files', 'generators')
+VerbsDir = os.path.join(RootDir, 'fips-files', 'verbs')
+
+KB = 1024
+MB = 1024 * 1024
+
+Scales = {
+    'quick': { 'embed': [ 16 * KB, 1 * MB, 16 * MB ], 'copy': [ 10000 ], 'markdeep': [ 2000 ] },
+    'full': { 'embed': [ 64 * KB, 16 * MB, 256 * MB ], 'copy': [ 10000, 100000 ], 'markdeep': [ 20000 ] }
+}
+
+# deploy modes of the copy workloads
+CopyModes = [ 'copy', 'hardlink', 'reflink', 'auto' ]
+
+Phases = [ 'cold', 'warm', 'noop' ]
+
+# default input sizes of the 'embed-format' benchmark
+FormatSizes = '1KB,1MB,64MB'
+
+# minimum time of an 'embed-format' sample, small inputs are encoded
+# repeatedly until it is reached
+MinFormatTime = 0.2
+
+# bump when the result layout changes
+ResultVersion = 1
+
+#-------------------------------------------------------------------------------
+def install_stubs() :
+    '''
+    Register minimal stand-ins for fips' genutil and mod packages.
+    '''
+    genutil = types.ModuleType('genutil')
+    genutil.Env = {}
+    genutil.location = [ None, 0 ]
+    def setErrorLocation(path, line) :
+        genutil.location[:] = [ path, line ]
+    def fmtError(msg, terminate=True) :
+        sys.stderr.write('{}:{}: error: {}\n'.format(genutil.location[0], genutil.location[1], msg))
+        if terminate :
+            sys.exit(10)
+    def isDirty(version, inputs, outputs) :
+        if not all(os.path.exists(path) for path in outputs) :
+            return True
+        return max(os.path.getmtime(path) for path in inputs) > min(os.path.getmtime(path) for path in outputs)
+    genutil.setErrorLocation = setErrorLocation
+    genutil.fmtError = fmtError
+    genutil.isDirty = isDirty
+    genutil.getEnv = lambda key, default=None : genutil.Env.get(key, default)
+
+    mod = types.ModuleType('mod')
+    log = types.ModuleType('mod.log')
+    log.YELLOW = log.RED = log.GREEN = log.BLUE = log.DEF = ''
+    log.info = lambda msg : None
+    log.colored = lambda color, msg : None
+    log.warn = lambda msg : None
+    def error(msg, fatal=True) :
+        sys.stderr.write('error: {}\n'.format(msg))
+        if fatal :
+            sys.exit(10)
+    log.error = error
+    util = types.ModuleType('mod.util')
+    util.get_project_name_from_dir = lambda proj_dir : os.path.basename(proj_dir)
+    util.get_workspace_dir = lambda fips_dir : os.path.dirname(fips_dir)
+    util.load_fips_yml = lambda proj_dir : {}
+    mod.log = log
+    mod.util = util
+    sys.modules.update({ 'genutil': genutil, 'mod': mod, 'mod.log': log, 'mod.util': util })
+
+#-------------------------------------------------------------------------------
+def load_module(name, path) :
+    '''
+    Import a generator or verb by path like fips does, the module is
+    not registered in sys.modules, so the benchmarks run the same code
+    paths as a real build (for instance, worker processes can't import
+    the module by name).
+    '''
+    if GeneratorsDir not in sys.path :
+        # for 'import fipsutil', appended so that the standard library wins
+        sys.path.append(GeneratorsDir)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+#-------------------------------------------------------------------------------
+def fmt_size(num_bytes) :
+    if num_bytes >= MB :
+        return '{}MB'.format(num_bytes // MB)
+    return '{}KB'.format(num_bytes // KB)
+
+#-------------------------------------------------------------------------------
+def write_random(path, size, rnd) :
+    with open(path, 'wb') as f :
+        remaining = size
+        while remaining > 0 :
+            chunk = min(remaining, 4 * MB)
+            f.write(rnd.randbytes(chunk))
+            remaining -= chunk
+
+#-------------------------------------------------------------------------------
+def setup_embed(work_dir, size) :
+    src_dir = os.path.join(work_dir, 'src')
+    os.makedirs(src_dir)
+    write_random(os.path.join(src_dir, 'data.bin'), size, random.Random(size))
+    with open(os.path.join(src_dir, 'embed.yml'), 'w') as f :
+        f.write('options:\n    list_items: true\nfiles:\n    - data.bin\n')
+    return { 'bytes': size, 'files': 1 }
+
+#-------------------------------------------------------------------------------
+def run_embed(work_dir, phase) :
+    # like fipsutil_embed(), the header is generated next to the inputs
+    src_dir = os.path.join(work_dir, 'src')
+    out_hdr = os.path.join(src_dir, 'data.h')
+    if phase == 'cold' :
+        for path in glob.glob(out_hdr + '*') :
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+    elif phase == 'warm' :
+        # a content change which forces a full re-encode
+        with open(os.path.join(src_dir, 'data.bin'), 'r+b') as f :
+            f.write(os.urandom(4 * KB))
+    embed = load_module('embed', os.path.join(GeneratorsDir, 'embed.py'))
+    start = time.perf_counter()
+    embed.generate(os.path.join(src_dir, 'embed.yml'), os.path.join(src_dir, 'data.c'), out_hdr)
+    return time.perf_counter() - start
+
+#-------------------------------------------------------------------------------
+def copy_mode_supported(work_dir, mode) :
+    '''
+    Returns True if a deploy mode works within the work directory.
+    '''
+    install_stubs()
+    copy = load_module('copy', os.path.join(GeneratorsDir, 'copy.py'))
+    src = os.path.join(work_dir, 'probe.src')
+    dst = os.path.join(work_dir, 'probe.dst')
+    with open(src, 'wb') as f :
+        f.write(b'probe')
+    try :
+        copy.deploy_file(src, dst, mode)
+        return True
+    except OSError :
+        return False
+    finally :
+        for path in [ src, dst ] :
+            if os.path.exists(path) :
+                os.remove(path)
+
+#-------------------------------------------------------------------------------
+def setup_copy(work_dir, param) :
+    num_files, mode = param
+    if not copy_mode_supported(work_dir, mode) :
+        return None
+    rnd = random.Random(num_files)
+    assets_dir = os.path.join(work_dir, 'src', 'assets')
+    total = 0
+    for i in range(num_files) :
+        dir_path = os.path.join(assets_dir, 'd{}'.format(i // 1000), 's{}'.format((i // 100) % 10))
+        if i % 100 == 0 :
+            os.makedirs(dir_path)
+        size = rnd.randint(256, 4 * KB)
+        with open(os.path.join(dir_path, 'f{}.bin'.format(i)), 'wb') as f :
+            f.write(rnd.randbytes(size))
+        total += size
+    with open(os.path.join(work_dir, 'src', 'copy.yml'), 'w') as f :
+        f.write('options:\n    mode: {}\nfiles:\n    - assets\n'.format(mode))
+    return { 'bytes': total, 'files': num_files }
+
+#-------------------------------------------------------------------------------
+def list_files(root) :
+    paths = []
+    for dir_path, _, file_names in os.walk(root) :
+        paths.extend(os.path.join(dir_path, name) for name in file_names)
+    return sorted(paths)
+
+#-------------------------------------------------------------------------------
+def touch_files(paths, fraction, text) :
+    '''
+    Append to every n-th file, with a distinct mtime.
+    '''
+    step = max(1, int(1 / fraction))
+    now = time.time() + 2
+    for path in paths[::step] :
+        with open(path, 'a' if text else 'ab') as f :
+            f.write('// changed\n' if text else b'\0')
+        os.utime(path, (now, now))
+
+#-------------------------------------------------------------------------------
+def run_copy(work_dir, phase) :
+    build_dir = os.path.join(work_dir, 'build')
+    deploy_dir = os.path.join(work_dir, 'deploy')
+    if phase == 'cold' :
+        shutil.rmtree(build_dir, ignore_errors=True)
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        os.makedirs(build_dir)
+    elif phase == 'warm' :
+        touch_files(list_files(os.path.join(work_dir, 'src', 'assets')), 0.01, False)
+    copy = load_module('copy', os.path.join(GeneratorsDir, 'copy.py'))
+    start = time.perf_counter()
+    copy.generate(os.path.join(work_dir, 'src', 'copy.yml'),
+        os.path.join(build_dir, 'copy.c'), os.path.join(build_dir, 'copy.h'),
+        { 'deploy_dir': deploy_dir, 'target_name': 'bench' })
+    return time.perf_counter() - start
+
+#-------------------------------------------------------------------------------
+def setup_markdeep(work_dir, num_headers) :
+    proj_dir = os.path.join(work_dir, 'ws', 'proj')
+    os.makedirs(os.path.join(work_dir, 'ws', 'fips'))
+    total = 0
+    for i in range(num_headers) :
+        dir_path = os.path.join(proj_dir, 'src', 'm{}'.format(i // 100))
+        if i % 100 == 0 :
+            os.makedirs(dir_path)
+        text = '#pragma once\n'
+        if i % 10 == 0 :
+            text += '/*#\n    # Module {}\n\n    Some documentation.\n#*/\n'.format(i)
+        text += ''.join('int func_{}_{}(int a, int b); /* not a doc comment */\n'.format(i, j) for j in range(100))
+        with open(os.path.join(dir_path, 'h{}.h'.format(i)), 'w') as f :
+            f.write(text)
+        total += len(text)
+    return { 'bytes': total, 'files': num_headers }
+
+#-------------------------------------------------------------------------------
+def run_markdeep(work_dir, phase) :
+    fips_dir = os.path.join(work_dir, 'ws', 'fips')
+    proj_dir = os.path.join(work_dir, 'ws', 'proj')
+    if phase == 'cold' :
+        shutil.rmtree(os.path.join(work_dir, 'ws', 'fips-deploy'), ignore_errors=True)
+    elif phase == 'warm' :
+        touch_files(list_files(os.path.join(proj_dir, 'src')), 0.01, True)
+    markdeep = load_module('markdeep', os.path.join(VerbsDir, 'markdeep.py'))
+    start = time.perf_counter()
+    markdeep.build(fips_dir, proj_dir)
+    return time.perf_counter() - start
+
+Workloads = {
+    'embed': (setup_embed, run_embed, fmt_size),
+    'copy': (setup_copy, run_copy, lambda param : '{}-{}'.format(*param)),
+    'markdeep': (setup_markdeep, run_markdeep, str)
+}
+
+#-------------------------------------------------------------------------------
+def run_phase_child(kind, phase, work_dir) :
+    '''
+    Entry point of the child process of one phase, prints the time as JSON.
+    '''
+    install_stubs()
+    # keep the caches of the shared YAML loader inside the work directory
+    cache_dir = os.path.join(work_dir, 'fipsutil-cache')
+    os.environ['FIPSUTIL_CACHE_DIR'] = cache_dir
+    if phase == 'cold' :
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    run_func = Workloads[kind][1]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull) :
+        seconds = run_func(work_dir, phase)
+    print(json.dumps({ 'time': seconds }))
+
+#-------------------------------------------------------------------------------
+def measure_phase(kind, phase, work_dir) :
+    '''
+    Run one phase in a child process, returns its time and peak RSS.
+    '''
+    cmd = [ sys.executable, os.path.abspath(__file__), 'phase', kind, phase, work_dir ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    maxrss = None
+    if hasattr(os, 'wait4') :
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+        maxrss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * KB
+    else :
+        proc.wait()
+    if proc.returncode != 0 :
+        sys.exit('{} {} phase failed with exit code {}'.format(kind, phase, proc.returncode))
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['maxrss'] = maxrss
+    return result
+
+#-------------------------------------------------------------------------------
+def median(values) :
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+#-------------------------------------------------------------------------------
+def run_benchmarks(args) :
+    scale = Scales[args.scale]
+    kinds = args.only.split(',') if args.only else sorted(Workloads)
+    root_dir = args.work_dir or tempfile.mkdtemp(prefix='fips-utils-bench-')
+    results = {}
+    try :
+        for kind in kinds :
+            if kind not in Workloads :
+                sys.exit("unknown workload '{}', expected one of: {}".format(kind, ', '.join(sorted(Workloads))))
+            setup_func, _, fmt_param = Workloads[kind]
+            params = scale[kind]
+            if kind == 'copy' :
+                params = [ (num_files, mode) for num_files in params for mode in args.copy_modes.split(',') ]
+            for param in params :
+                name = '{}-{}'.format(kind, fmt_param(param))
+                work_dir = os.path.join(root_dir, name)
+                shutil.rmtree(work_dir, ignore_errors=True)
+                os.makedirs(work_dir)
+                sizes = setup_func(work_dir, param)
+                if sizes is None :
+                    print('{:<24} skipped, not supported in {}'.format(name, root_dir))
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                    continue
+                results[name] = {}
+                for phase in Phases :
+                    # each phase prepares its own starting state (clearing
+                    # outputs, changing inputs), so it can simply be repeated
+                    samples = [measure_phase(kind, phase, work_dir) for _ in range(args.repeat)]
+                    seconds = median([s['time'] for s in samples])
+                    maxrss = max(s['maxrss'] for s in samples) if samples[0]['maxrss'] is not None else None
+                    results[name][phase] = {
+                        'time': seconds,
+                        'maxrss': maxrss,
+                        'bytes': sizes['bytes'],
+                        'files': sizes['files'],
+                        'mb_per_s': sizes['bytes'] / MB / seconds if seconds else None,
+                        'files_per_s': sizes['files'] / seconds if seconds else None
+                    }
+                    print_result(name, phase, results[name][phase])
+                shutil.rmtree(work_dir, ignore_errors=True)
+    finally :
+        if not args.work_dir :
+            shutil.rmtree(root_dir, ignore_errors=True)
+    return {
+        'version': ResultVersion,
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results
+    }
+
+#-------------------------------------------------------------------------------
+def print_result(name, phase, res) :
+    maxrss = '{:.1f} MB'.format(res['maxrss'] / float(MB)) if res['maxrss'] is not None else '-'
+    print('{:<24} {:<5} {:>10.1f} ms {:>10.1f} MB/s {:>10.0f} files/s {:>12}'.format(
+        name, phase, res['time'] * 1000.0, res['mb_per_s'] or 0.0, res['files_per_s'] or 0.0, maxrss))
+
+#-------------------------------------------------------------------------------
+def compare(new, baseline, threshold, mem_threshold, min_time) :
+    '''
+    Print the changes against a baseline, returns the list of regressions.
+    '''
+    regressions = []
+    for name, phases in sorted(new['results'].items()) :
+        for phase in Phases :
+            res = phases.get(phase)
+            base = baseline['results'].get(name, {}).get(phase)
+            if not res or not base :
+                continue
+            change = (res['time'] - base['time']) * 100.0 / base['time'] if base['time'] else 0.0
+            line = '{:<24} {:<5} {:>10.1f} ms => {:>10.1f} ms ({:+.1f}%)'.format(
+                name, phase, base['time'] * 1000.0, res['time'] * 1000.0, change)
+            if change > threshold and res['time'] - base['time'] > min_time :
+                regressions.append('{} {}: time {:+.1f}%'.format(name, phase, change))
+                line += '  REGRESSION'
+            if res['maxrss'] and base['maxrss'] :
+                mem_change = (res['maxrss'] - base['maxrss']) * 100.0 / base['maxrss']
+                line += ', peak memory {:+.1f}%'.format(mem_change)
+                if mem_change > mem_threshold :
+                    regressions.append('{} {}: peak memory {:+.1f}%'.format(name, phase, mem_change))
+                    line += '  REGRESSION'
+            print(line)
+    return regressions
+
+#-------------------------------------------------------------------------------
+def load_results(path) :
+    with open(path, 'r') as f :
+        results = json.load(f)
+    if results.get('version') != ResultVersion :
+        sys.exit("'{}' has an incompatible result version".format(path))
+    return results
+
+#-------------------------------------------------------------------------------
+def check_baseline(new, baseline_path, args) :
+    baseline = load_results(baseline_path)
+    if baseline['scale'] != new['scale'] :
+        print("warning: comparing scale '{}' against baseline scale '{}'".format(new['scale'], baseline['scale']))
+    regressions = compare(new, baseline, args.threshold, args.mem_threshold, args.min_time)
+    if regressions :
+        print('{} regression(s):'.format(len(regressions)))
+        for regression in regressions :
+            print('  ' + regression)
+        sys.exit(1)
+    print('no regressions')
+
+#-------------------------------------------------------------------------------
+def parse_size(text) :
+    for suffix, unit in [ ('KB', KB), ('MB', MB) ] :
+        if text.upper().endswith(suffix) :
+            return int(text[:-len(suffix)]) * unit
+    return int(text)
+
+#-------------------------------------------------------------------------------
+def write_bytes_loop(f, data) :
+    '''
+    The original per-byte array encoder of embed.gen_header(), as reference.
+    '''
+    num = 0
+    for byte in data :
+        f.write(hex(ord(chr(byte))) + ', ')
+        num += 1
+        if 0 == num%16:
+            f.write('\n')
+
+#-------------------------------------------------------------------------------
+def time_encoder(func, data, path, repeat) :
+    '''
+    Returns the best throughput in MB/s of repeat samples, each sample
+    encodes the data into a file until MinFormatTime has passed.
+    '''
+    best = 0.0
+    for _ in range(repeat) :
+        count = 0
+        start = time.perf_counter()
+        while True :
+            with open(path, 'w') as f :
+                func(f, data)
+            count += 1
+            seconds = time.perf_counter() - start
+            if seconds >= MinFormatTime :
+                break
+        best = max(best, len(data) * count / MB / seconds)
+    return best
+
+#-------------------------------------------------------------------------------
+def run_format_benchmark(args) :
+    install_stubs()
+    embed = load_module('embed', os.path.join(GeneratorsDir, 'embed.py'))
+    work_dir = tempfile.mkdtemp(prefix='fips-utils-bench-')
+    try :
+        print('{:<8} {:>16} {:>16} {:>9}'.format('size', 'loop', 'write_bytes', 'speedup'))
+        for size in [ parse_size(text) for text in args.sizes.split(',') ] :
+            data = random.Random(size).randbytes(size)
+            loop_path = os.path.join(work_dir, 'loop.txt')
+            chunked_path = os.path.join(work_dir, 'chunked.txt')
+            loop_mbs = time_encoder(write_bytes_loop, data, loop_path, args.repeat)
+            chunked_mbs = time_encoder(embed.write_bytes, data, chunked_path, args.repeat)
+            if not filecmp.cmp(loop_path, chunked_path, shallow=False) :
+                sys.exit('{}: write_bytes output differs from the original loop'.format(fmt_size(size)))
+            print('{:<8} {:>11.1f} MB/s {:>11.1f} MB/s {:>8.1f}x'.format(
+                fmt_size(size), loop_mbs, chunked_mbs, chunked_mbs / loop_mbs))
+    finally :
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+#-------------------------------------------------------------------------------
+def main() :
+    if len(sys.argv) == 5 and sys.argv[1] == 'phase' :
+        run_phase_child(sys.argv[2], sys.argv[3], sys.argv[4])
+        return
+    parser = argparse.ArgumentParser(description='benchmarks for the fips-utils generators and markdeep verb')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run_parser = sub.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--scale', choices=sorted(Scales), default='quick')
+    run_parser.add_argument('--only', help='comma-separated workloads: ' + ', '.join(sorted(Workloads)))
+    run_parser.add_argument('--copy-modes', default=','.join(CopyModes), help='comma-separated deploy modes of the copy workloads')
+    run_parser.add_argument('--repeat', type=int, default=3, help='runs per phase, the median time is used')
+    run_parser.add_argument('--work-dir', help='directory for the workloads (default: temporary directory)')
+    run_parser.add_argument('--out', help='write the results to this JSON file')
+    run_parser.add_argument('--baseline', help='compare the results against this JSON file')
+    cmp_parser = sub.add_parser('compare', help='compare two result files')
+    cmp_parser.add_argument('new')
+    cmp_parser.add_argument('baseline')
+    fmt_parser = sub.add_parser('embed-format', help='compare the embed array encoder with the original loop')
+    fmt_parser.add_argument('--sizes', default=FormatSizes, help='comma-separated input sizes (default: {})'.format(FormatSizes))
+    fmt_parser.add_argument('--repeat', type=int, default=1, help='samples per encoder, the best one is used')
+    for p in [ run_parser, cmp_parser ] :
+        p.add_argument('--threshold', type=float, default=10.0, help='allowed time increase in percent')
+        p.add_argument('--mem-threshold', type=float, default=10.0, help='allowed peak memory increase in percent')
+        p.add_argument('--min-time', type=float, default=0.005, help='ignore time increases below this many seconds')
+    args = parser.parse_args()
+
+    if args.command in [ 'run', 'embed-format' ] and args.repeat < 1 :
+        sys.exit('--repeat must be at least 1')
+    if args.command == 'embed-format' :
+        run_format_benchmark(args)
+    elif args.command == 'run' :
+        for mode in args.copy_modes.split(',') :
+            if mode not in CopyModes :
+                sys.exit("unknown copy mode '{}', expected one of: {}".format(mode, ', '.join(CopyModes)))
+        new = run_benchmarks(args)
+        if args.out :
+            with open(args.out, 'w') as f :
+                json.dump(new, f, indent=2, sort_keys=True)
+            print("results written to '{}'".format(args.out))
+        if args.baseline :
+            check_baseline(new, args.baseline, args)
+    else :
+        check_baseline(load_results(args.new), args.baseline, args)
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,64 @@
+'''
+    batchutil.py
+
+    Shared helpers of the '--batch' modes of the 'gdb' and 'valgrind'
+    verbs (not a generator). Every module in the verbs directory is
+    loaded as a verb, so the verbs load this one by file path, like
+    forkutil.py.
+'''
+
+import multiprocessing
+from mod import log, config, project, settings
+
+#-------------------------------------------------------------------------------
+def parse_batch_args(proj_dir, args, opts) :
+    '''
+    Parse the arguments of a verb's '--batch' mode: target names and
+    '--key=value' options. opts has the verb's own options with their
+    defaults, '--config' and '--jobs' are always accepted. Returns the
+    config name, the targets and the options.
+    '''
+    batch_opts = { '--config': None, '--jobs': multiprocessing.cpu_count() }
+    batch_opts.update(opts)
+    targets = []
+    for arg in args :
+        if arg == '--batch' :
+            continue
+        if arg.startswith('--') :
+            key, _, value = arg.partition('=')
+            if key not in batch_opts or not value :
+                log.error("invalid batch option '{}'".format(arg))
+            batch_opts[key] = value
+        else :
+            targets.append(arg)
+    cfg_name = batch_opts['--config'] or settings.get(proj_dir, 'config')
+    if not targets :
+        targets = [ settings.get(proj_dir, 'target') or 'all' ]
+    return cfg_name, targets, batch_opts
+
+#-------------------------------------------------------------------------------
+def get_app_targets(fips_dir, proj_dir, cfg_name) :
+    success, targets = project.get_target_list(fips_dir, proj_dir, cfg_name)
+    if not success :
+        log.error("failed to get target list of config '{}', run 'fips gen' first".format(cfg_name))
+    return sorted(name for name, kind in targets.items() if kind == 'app')
+
+#-------------------------------------------------------------------------------
+def get_batch_targets(fips_dir, proj_dir, cfg_name, targets) :
+    '''
+    Returns the [config name, target names] pairs of a batch run, the
+    target 'all' stands for all app targets of a config.
+    '''
+    configs = config.load(fips_dir, proj_dir, cfg_name)
+    if not configs :
+        log.error("No valid configs found for '{}'".format(cfg_name))
+    batch_targets = []
+    for cfg in configs :
+        config_valid, _ = config.check_config_valid(fips_dir, proj_dir, cfg, print_errors = True)
+        if not config_valid :
+            log.error("Config '{}' not valid in this environment".format(cfg['name']))
+        cfg_targets = targets
+        if targets == ['all'] :
+            cfg_targets = get_app_targets(fips_dir, proj_dir, cfg['name'])
+        batch_targets.append([cfg['name'], cfg_targets])
+    return batch_targets
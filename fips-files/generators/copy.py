@@ -15,6 +15,10 @@
             dst_dir:    [optional relative dst_dir for iOS]
         macos:
             dst_dir:    [optional relative dst_dir for macOS]
+        compare: [optional 'mtime' (default) or 'hash']
+        mode: [optional 'copy' (default), 'hardlink', 'reflink' or 'auto']
+        jobs: [optional number of copy threads, default is CPU count + 4, max 32]
+        profile: [optional, write timings to a build report, see fipsutil.py]
     files:
         - DroidSansJapanese.ttf
         - DroidSerif-Bold.ttf
@@ -34,42 +38,293 @@
     fipsutil_copy(yml_file.yml)
 
     This macro is defined in fips-utils/fips-files/include.cmake.
+
+    Directories are synced into the deploy dir: only new or changed files
+    are copied, and files which no longer exist in the source directory
+    are deleted. Files are compared by size and modification time, or with
+    'compare: hash' by size and content hash.
+
+    The option 'mode' selects how files are deployed:
+
+    - 'copy': regular file copies
+    - 'hardlink': hardlinks to the source files (source and deploy dir
+      must be on the same filesystem, and writing to a deployed file
+      also changes the source file)
+    - 'reflink': copy-on-write clones (e.g. btrfs/xfs on Linux, APFS on macOS)
+    - 'auto': uses reflinks if supported, then copy_file_range() (Linux),
+      and falls back to regular copies, for instance when crossing
+      filesystem boundaries
+
+    Files are synced in parallel on a pool of 'jobs' threads.
+
+    To make no-op builds cheap, the directory listings of the dirty check
+    are cached in a manifest in the build directory, directories which
+    haven't changed since the last build are not listed again.
 '''
 Version = 2
 
 import genutil as util
 import subprocess
 import shutil
-import yaml
+import fipsutil
 import os
+import sys
+import errno
+import json
+import hashlib
+import time
 import platform
+import ctypes
+import concurrent.futures
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from shutil import ignore_patterns
 
 # -------------------------------------------------------------------------------
-def copy_files(src_dir, dst_dir, ignore_list, config):
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# -------------------------------------------------------------------------------
+def is_up_to_date(src, dst, src_stat, compare):
+    # compares by size and exact mtime (copy2() and copystat() preserve the
+    # mtime in nanoseconds, so a same-size edit within the same second is
+    # still detected), or by size and content hash
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if compare == 'hash':
+        return hash_file(src) == hash_file(dst)
+    return src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+# -------------------------------------------------------------------------------
+# ioctl to clone a file's extents on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# errors which mean that a deploy mode isn't supported between two paths
+UnsupportedErrors = set([errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+    errno.ENOSYS, errno.ENOTTY, errno.EPERM])
+
+# the cheapest working deploy mode per (mode, src device, dst device)
+ModeCache = {}
+
+
+# -------------------------------------------------------------------------------
+def copy_file(src, dst):
+    shutil.copy2(src, dst)
+
+
+# -------------------------------------------------------------------------------
+def hardlink_file(src, dst):
+    os.link(src, dst)
+
+
+# -------------------------------------------------------------------------------
+def reflink_file(src, dst):
+    # copy-on-write clone, the data blocks are shared until modified
+    if sys.platform.startswith('linux'):
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                except (IOError, OSError) as err:
+                    raise OSError(err.errno, err.strerror, dst)
+    elif sys.platform == 'darwin':
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(src.encode('utf-8'), dst.encode('utf-8'), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dst)
+    else:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks not supported on this platform', dst)
+    shutil.copystat(src, dst)
+
+
+# -------------------------------------------------------------------------------
+def copy_file_range(src, dst):
+    # in-kernel copy, may be offloaded to the filesystem or server
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range() not available', dst)
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                num_bytes = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if num_bytes == 0:
+                    break
+                remaining -= num_bytes
+    shutil.copystat(src, dst)
+
+
+DeployFuncs = {
+    'copy': copy_file,
+    'hardlink': hardlink_file,
+    'reflink': reflink_file,
+    'copy_file_range': copy_file_range,
+}
+
+# 'auto' tries the cheapest mode first, hardlinks are never used
+# automatically since the deployed file would alias the source file
+AutoModes = ['reflink', 'copy_file_range', 'copy']
+
+
+# -------------------------------------------------------------------------------
+def deploy_file(src, dst, mode):
+    # returns the deploy mode which was actually used
+    if os.path.lexists(dst):
+        # never write through an existing (hard)link into the source file
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        else:
+            os.remove(dst)
+    modes = [mode]
+    if mode == 'auto':
+        key = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+        modes = AutoModes[AutoModes.index(ModeCache.get(key, AutoModes[0])):]
+    for cur_mode in modes:
+        try:
+            DeployFuncs[cur_mode](src, dst)
+            if mode == 'auto':
+                ModeCache[key] = cur_mode
+            return cur_mode
+        except OSError as err:
+            # don't leave a partial file behind
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if mode != 'auto' or cur_mode == 'copy' or err.errno not in UnsupportedErrors:
+                raise
+
+
+# -------------------------------------------------------------------------------
+def remove_path(path, stats):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    stats['deleted'] += 1
+
+
+# -------------------------------------------------------------------------------
+def sync_file(src, dst, compare, mode):
+    # called on the copy threads, returns the file size and the
+    # deploy mode used, or None if the file was up to date
+    src_stat = os.stat(src)
+    if is_up_to_date(src, dst, src_stat, compare):
+        return src_stat.st_size, None
+    return src_stat.st_size, deploy_file(src, dst, mode)
+
+
+# -------------------------------------------------------------------------------
+def make_dir(path, created_dirs):
+    if path not in created_dirs:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        created_dirs.add(path)
+
+
+# -------------------------------------------------------------------------------
+def sync_tree(src, dst, ignore, tasks, created_dirs, stats):
+    # rsync-like directory sync: creates the destination directories, deletes
+    # files which no longer exist in the source (or are ignored), and collects
+    # the files to sync in tasks, only new or changed files are copied
+    names = os.listdir(src)
+    ignored_names = ignore(src, names)
+    if os.path.lexists(dst) and not os.path.isdir(dst):
+        remove_path(dst, stats)
+    make_dir(dst, created_dirs)
+    stale_names = set(os.listdir(dst))
+    for name in names:
+        if name in ignored_names:
+            continue
+        stale_names.discard(name)
+        src_path = os.path.join(src, name)
+        dst_path = os.path.join(dst, name)
+        if os.path.isdir(src_path):
+            sync_tree(src_path, dst_path, ignore, tasks, created_dirs, stats)
+        else:
+            tasks.append((src_path, dst_path))
+    for name in sorted(stale_names):
+        remove_path(os.path.join(dst, name), stats)
+
+
+# -------------------------------------------------------------------------------
+def sync_files(tasks, compare, mode, jobs, stats, errors):
+    # sync files on a bounded thread pool, copying is I/O bound so threads
+    # can run in parallel
+    if jobs > 1 and len(tasks) > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        futures = [pool.submit(sync_file, src, dst, compare, mode) for src, dst in tasks]
+    else:
+        pool = None
+        futures = None
+    for i, (src, dst) in enumerate(tasks):
+        try:
+            if futures:
+                size, used_mode = futures[i].result()
+            else:
+                size, used_mode = sync_file(src, dst, compare, mode)
+        except (IOError, OSError) as err:
+            errors.append("Failed to copy file '{}' with '{}'".format(err.filename or src, err.strerror))
+            continue
+        if used_mode:
+            stats['copied'] += 1
+            stats['copied_bytes'] += size
+            stats['modes'][used_mode] = stats['modes'].get(used_mode, 0) + 1
+        else:
+            stats['skipped'] += 1
+            stats['skipped_bytes'] += size
+    if pool:
+        pool.shutdown()
+
+
+# -------------------------------------------------------------------------------
+def copy_files(src_dir, dst_dir, ignore_list, compare, mode, jobs, config, profile):
+    stats = {'copied': 0, 'copied_bytes': 0, 'skipped': 0, 'skipped_bytes': 0, 'deleted': 0, 'modes': {}}
+    log = []
+    tasks = []
+    errors = []
+    created_dirs = set()
+    read_start_time = time.time()
     for filename in config['files']:
         src = os.path.join(src_dir, filename)
         dst = os.path.join(dst_dir, filename)
-        print("## cp '{}' => '{}'".format(filename, dst))
+        log.append("## cp '{}' => '{}'".format(filename, dst))
 
         if os.path.isdir(src):
-            # if the folder already exists, copytree will unfortunately fail. This is fixed in 3.8+, but for now this is the easiest solution
-            if os.path.exists(dst):
-                shutil.rmtree(dst)
             try:
-                shutil.copytree(src, dst, ignore=ignore_patterns(*ignore_list))
-            except IOError as err:
+                sync_tree(src, dst, ignore_patterns(*ignore_list), tasks, created_dirs, stats)
+            except (IOError, OSError) as err:
                 # show a proper error if file copying fails
-                util.fmtError("Failed to copy folder '{}' with '{}'".format(err.filename, err.strerror))
+                errors.append("Failed to copy folder '{}' with '{}'".format(err.filename, err.strerror))
         else:
-            if not os.path.exists(os.path.dirname(dst)):
-                os.makedirs(os.path.dirname(dst))
             try:
-                shutil.copyfile(src, dst)
-            except IOError as err:
-                # show a proper error if file copying fails
-                util.fmtError("Failed to copy file '{}' with '{}'".format( err.filename, err.strerror))
+                make_dir(os.path.dirname(dst), created_dirs)
+                tasks.append((src, dst))
+            except (IOError, OSError) as err:
+                errors.append("Failed to copy file '{}' with '{}'".format(err.filename, err.strerror))
+    profile.add_time('read', time.time() - read_start_time)
+    with profile.phase('write'):
+        sync_files(tasks, compare, mode, jobs, stats, errors)
+    profile.count(stats['copied'], stats['copied_bytes'])
+    modes = ', '.join('{}: {}'.format(m, n) for m, n in sorted(stats['modes'].items()))
+    log.append("## cp: {} copied ({} bytes{}), {} skipped ({} bytes), {} deleted".format(
+        stats['copied'], stats['copied_bytes'], ', ' + modes if modes else '',
+        stats['skipped'], stats['skipped_bytes'], stats['deleted']))
+    print('\n'.join(log))
+    # show all errors, and terminate after the last one
+    for i, msg in enumerate(errors):
+        util.fmtError(msg, i == len(errors) - 1)
 
 
 #-------------------------------------------------------------------------------
@@ -84,35 +339,150 @@ def gen_header(out_dummy_file):
 
 
 #-------------------------------------------------------------------------------
-def check_dirty(src_root_path, input, out_dummy_file, config):
-    out_files = [out_dummy_file]
-    in_files = [input]
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == Version:
+            return manifest
+    except (IOError, OSError, ValueError):
+        pass
+    return {'version': Version, 'dirs': {}}
+
+
+#-------------------------------------------------------------------------------
+def save_manifest(manifest_path, manifest):
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+#-------------------------------------------------------------------------------
+def is_newer(path, out_mtime):
+    # missing or broken files are treated as dirty, the copy step will report them
+    try:
+        return os.stat(path).st_mtime > out_mtime
+    except OSError:
+        return True
+
+
+#-------------------------------------------------------------------------------
+# the coarsest filesystem timestamp granularity (FAT), see scan_dir()
+MtimeGranularity = 2.0
+
+
+#-------------------------------------------------------------------------------
+def scan_dir(path, cached_dirs, scanned_dirs, out_mtime, stats):
+    # A directory's mtime only changes when entries are added, removed or
+    # renamed, so if it matches the manifest, the cached file and subdir
+    # lists are used instead of listing the directory again. The files
+    # themselves still need to be stat'ed to catch modified content.
+    # Like git's racy index check, a listing is only trusted if the
+    # directory's mtime is clearly older than the time it was taken,
+    # otherwise an entry added in the same timestamp tick could be missed.
+    # Returns True as soon as a file newer than out_mtime is found.
+    list_time = time.time()
+    dir_mtime = os.stat(path).st_mtime
+    stats['entries'] += 1
+    cached = cached_dirs.get(path)
+    dirty = False
+    if cached and cached['mtime'] == dir_mtime and dir_mtime < cached.get('time', 0) - MtimeGranularity:
+        files = cached['files']
+        subdirs = cached['dirs']
+        scanned_dirs[path] = cached
+        for name in files:
+            stats['entries'] += 1
+            if is_newer(os.path.join(path, name), out_mtime):
+                return True
+    else:
+        files = []
+        subdirs = []
+        for entry in os.scandir(path):
+            stats['entries'] += 1
+            # same as os.walk(), symlinked directories are not followed
+            if entry.is_dir() and not entry.is_symlink():
+                subdirs.append(entry.name)
+            elif not entry.is_dir():
+                files.append(entry.name)
+                if not dirty:
+                    try:
+                        dirty = entry.stat().st_mtime > out_mtime
+                    except OSError:
+                        dirty = True
+        scanned_dirs[path] = {'mtime': dir_mtime, 'time': list_time, 'files': files, 'dirs': subdirs}
+        # files added or removed since the last check (possibly with an
+        # old mtime, for instance extracted from an archive)
+        if cached and (sorted(files) != sorted(cached['files']) or sorted(subdirs) != sorted(cached['dirs'])):
+            dirty = True
+        if dirty:
+            return True
+    for subdir in subdirs:
+        if scan_dir(os.path.join(path, subdir), cached_dirs, scanned_dirs, out_mtime, stats):
+            return True
+    return False
+
+
+#-------------------------------------------------------------------------------
+def check_dirty(src_root_path, input, out_dummy_file, config, manifest_path):
+    # returns the dirty state and the manifest with the scanned directory
+    # listings, which must only be saved once the files are deployed, or
+    # None if the listings haven't changed
+    # output missing, generator version or YAML file changed
+    if util.isDirty(Version, [input], [out_dummy_file]):
+        return True, None
+
+    start_time = time.time()
+    out_mtime = os.path.getmtime(out_dummy_file)
+    manifest = load_manifest(manifest_path)
+    scanned_dirs = {}
+    stats = {'entries': 0}
+    dirty = False
     if 'files' in config:
         for filename in config['files']:
             abs_path = os.path.abspath(os.path.join(src_root_path, filename))
             if os.path.isdir(abs_path):
-                for root, dirs, files in os.walk(abs_path):
-                    for file in files:
-                        in_files.append(os.path.abspath(os.path.join(src_root_path, filename, file)))
+                dirty = scan_dir(abs_path, manifest['dirs'], scanned_dirs, out_mtime, stats)
             else:
-                in_files.append(abs_path)
-
-    return util.isDirty(Version, in_files, out_files)
+                stats['entries'] += 1
+                dirty = is_newer(abs_path, out_mtime)
+            if dirty:
+                break
+    if dirty:
+        # keep cached directories which haven't been visited
+        dirs = dict(manifest['dirs'])
+        dirs.update(scanned_dirs)
+    else:
+        dirs = scanned_dirs
+    print("## cp: dirty check visited {} entries in {:.1f} ms".format(stats['entries'], (time.time() - start_time) * 1000.0))
+    if dirs == manifest['dirs']:
+        return dirty, None
+    manifest['dirs'] = dirs
+    return dirty, manifest
 
 
 #-------------------------------------------------------------------------------
 def generate(input, out_src, out_hdr, args):
-    with open(input, 'r') as f:
-        try:
-            config = yaml.load(f)
-        except yaml.YAMLError as exc:
-            # show a proper error if YAML parsing fails
-            util.setErrorLocation(exc.problem_mark.name, exc.problem_mark.line-1)
-            util.fmtError('YAML error: {}'.format(exc.problem))
+    profile = fipsutil.Profile('copy', input)
+    try:
+        gen_copy(input, out_hdr, args, profile)
+    finally:
+        profile.finish()
+
+
+#-------------------------------------------------------------------------------
+def gen_copy(input, out_hdr, args, profile):
+    # the cached config is shared, don't modify it in place
+    with profile.phase('yaml'):
+        config = dict(fipsutil.load_config(input, tag='copy:{}'.format(Version)))
     util.setErrorLocation(input, 1)
 
     src_root_path = os.path.dirname(input)
     dst_dir = args['deploy_dir']
+    compare = 'mtime'
+    mode = 'copy'
+    jobs = min(32, (os.cpu_count() or 1) + 4)
 
     if 'options' in config:
         if 'src_dir' in config['options']:
@@ -127,6 +497,22 @@ def generate(input, out_src, out_hdr, args):
         elif 'dst_dir' in config['options']:
             dst_dir = os.path.join(dst_dir, config['options']['dst_dir'])
 
+        if 'compare' in config['options']:
+            compare = config['options']['compare']
+            if compare not in ['mtime', 'hash']:
+                util.fmtError("Invalid compare option '{}' (must be 'mtime' or 'hash')".format(compare))
+
+        if 'mode' in config['options']:
+            mode = config['options']['mode']
+            if mode not in ['copy', 'hardlink', 'reflink', 'auto']:
+                util.fmtError("Invalid mode option '{}' (must be 'copy', 'hardlink', 'reflink' or 'auto')".format(mode))
+
+        if 'jobs' in config['options']:
+            jobs = config['options']['jobs']
+
+        if config['options'].get('profile'):
+            profile.enable()
+
         del config['options']
 
     dst_dir = dst_dir.replace('$TARGET_NAME', args['target_name'])
@@ -138,6 +524,14 @@ def generate(input, out_src, out_hdr, args):
 
     if not os.path.exists(dst_dir):
         os.makedirs(dst_dir)
-    if check_dirty(src_root_path, input, out_dummy_file, config):
-        copy_files(src_root_path, dst_dir, ignore_list, config)
+    manifest_path = out_hdr + '.manifest.json'
+    with profile.phase('dirty'):
+        dirty, manifest = check_dirty(src_root_path, input, out_dummy_file, config, manifest_path)
+    if dirty:
+        copy_files(src_root_path, dst_dir, ignore_list, compare, mode, jobs, config, profile)
         gen_header(out_dummy_file)
+    # only reached if the copy succeeded (errors terminate the generator),
+    # otherwise the next build would see matching listings and skip the copy,
+    # an unchanged manifest isn't rewritten
+    if manifest:
+        save_manifest(manifest_path, manifest)
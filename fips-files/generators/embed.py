@@ -12,6 +12,13 @@
             prefix: [optional C name prefix, default is 'embed_']
             src_dir: [optional relative source directory]
             list_items: true [default is false, see below]
+            compress: [optional 'zlib' or 'deflate', default is no compression]
+            compress_level: [optional compression level 1..9, default is 9]
+            format: [optional 'array', 'string' or 'incbin', default is 'array']
+            jobs: [optional number of encoder processes, default is the CPU count]
+            dedup: [optional, default is false, see below]
+            shared: [optional path of a shared header, see below]
+            profile: [optional, write timings to a build report, see fipsutil.py]
         files:
             - c64_basic.bin
             - c64_char.bin
@@ -40,14 +47,85 @@
 
     If the option 'list_items: "full"' is provided, the behaviour is similar to when
     'list_items: true' is used, but, the "real" filenames will be used in the list.
+
+    The generator keeps a manifest with the size, modification time and
+    content hash of each embedded file, together with the already encoded
+    array data, in a '[dst.h].embed' directory next to the output header
+    (this should be added to .gitignore). Only files which actually changed
+    are re-encoded, and the output header is only rewritten if its
+    content changes. Changed files are encoded in parallel on a pool
+    of 'jobs' processes, each input file is memory-mapped and encoded
+    chunk by chunk, so that memory usage stays bounded for huge files.
+
+    If the option 'compress: zlib' (or 'compress: deflate') is provided,
+    each file is stored compressed as a zlib stream (or raw deflate stream),
+    and the C array only contains the compressed data. Files which don't
+    get smaller (for instance already compressed audio or images) are
+    stored uncompressed, and compression can be disabled per file:
+
+        files:
+            - c64_basic.bin
+            - { file: music.ogg, compress: false }
+
+    In compressed mode, the item_t struct gets an additional member with the
+    uncompressed size, 'size' is the number of bytes stored in the array.
+    Items with 'size == unpacked_size' are stored uncompressed:
+
+        typedef struct { const char* name; const uint8_t* ptr; int size; int unpacked_size; } [prefix_]item_t;
+
+    For each compressed array, a define '[PREFIX][FILE NAME]_[FILE EXTENSION]_UNPACKED_SIZE'
+    with the uncompressed size is also written to the header.
+
+    The option 'format' selects how the data is presented to the compiler:
+
+    - 'array': the default, an initializer list of hex numbers
+    - 'string': a single (concatenated) escaped string literal, which is
+      much cheaper to parse for the compiler. The C array has one extra
+      byte for the terminating zero, the size in the item_t table is the
+      size of the data. Note that MSVC limits string literals to 64 KBytes.
+    - 'incbin': the data is included by an assembler source file
+      via '.incbin', and the header only contains 'extern const' declarations,
+      so that the compiler never needs to parse the data. This needs an
+      additional output file name for the assembler source, which must
+      have the extension '.S' so that it is preprocessed (GCC and Clang
+      only):
+
+        fipsutil_embed(src.yml dst.h dst.S)
+
+      If an assembler source is provided with the other formats, it is
+      written without any data.
+
+    With the option 'dedup: true', files with identical content are only
+    embedded once, additional file names become '#define' aliases of the
+    first array, and the item_t table entries point to the shared array.
+    This is opt-in since code which declares or defines the aliased names
+    itself won't compile anymore.
+
+    With the option 'shared: [path]', the data of all files is moved into
+    a shared header (relative to the output header) which can be used by
+    several YAML files, so that identical files are only embedded once
+    across all headers. The individual headers only contain 'extern'
+    declarations of the shared arrays (named after their content hash)
+    and '#define' aliases, the shared header must be included in exactly
+    one source file. The 'shared' option can't be used with the 'incbin'
+    format. When the option is removed again, the header's blobs are
+    removed from the shared header.
 '''
 
-Version = 6
+Version = 12
 
 import sys
-import os.path
-import yaml
+import os
+import json
+import shutil
+import filecmp
+import hashlib
+import zlib
+import time
+import mmap
+import multiprocessing
 import genutil
+import fipsutil
 
 #-------------------------------------------------------------------------------
 def get_file_path(filename, src_dir, file_path) :
@@ -62,36 +140,505 @@ def get_file_cname(filename, prefix) :
     return '{}{}'.format(prefix, filename).replace('.','_')
 
 #-------------------------------------------------------------------------------
-def gen_header(out_hdr, src_dir, files, prefix, list_items) :
-    with open(out_hdr, 'w') as f:
+# byte-to-text lookup tables for the array encoder, every 16th byte
+# is followed by a newline
+ByteText = ['{}, '.format(hex(i)) for i in range(256)]
+ByteTextNewline = ['{}, \n'.format(hex(i)) for i in range(256)]
+
+# number of bytes formatted per write (must be a multiple of 16)
+ChunkSize = 256 * 1024
+
+#-------------------------------------------------------------------------------
+def write_bytes(f, data) :
+    '''
+    Write binary data as comma-separated hex numbers, 16 per line.
+    Formats the data in large chunks through the lookup tables
+    and issues one write per chunk.
+    '''
+    if sys.version_info[0] >= 3:
+        view = memoryview(data)
+    else:
+        view = bytearray(data)
+    for pos in range(0, len(view), ChunkSize) :
+        chunk = view[pos:pos+ChunkSize]
+        text = list(map(ByteText.__getitem__, chunk))
+        text[15::16] = map(ByteTextNewline.__getitem__, chunk[15::16])
+        f.write(''.join(text))
+
+#-------------------------------------------------------------------------------
+# byte-to-text lookup table for the string literal encoder, printable
+# characters are written as is, everything else as 3-digit octal escape
+# (which can't swallow a following digit like a hex escape would),
+# '?' is escaped to prevent trigraphs
+StringText = [chr(i) if 32 <= i < 127 and chr(i) not in '"\\?' else '\\{:03o}'.format(i) for i in range(256)]
+
+# number of bytes per string literal line
+StringLineSize = 64
+
+#-------------------------------------------------------------------------------
+def write_string(f, data) :
+    '''
+    Write binary data as a C string literal, split into lines of
+    concatenated literals.
+    '''
+    if sys.version_info[0] >= 3:
+        view = memoryview(data)
+    else:
+        view = bytearray(data)
+    if len(view) == 0 :
+        f.write('""\n')
+    for pos in range(0, len(view), ChunkSize) :
+        chunk = view[pos:pos+ChunkSize]
+        f.write(''.join(['"{}"\n'.format(''.join(map(StringText.__getitem__, chunk[i:i+StringLineSize])))
+            for i in range(0, len(chunk), StringLineSize)]))
+
+#-------------------------------------------------------------------------------
+# start of the assembler source for the 'incbin' format
+AsmPrologue = '''/* #version:{}# */
+/* machine generated, do not edit! */
+#if defined(__APPLE__)
+#define EMBED_SYMBOL(name) _##name
+    .const_data
+#elif defined(_WIN32)
+#if defined(_WIN64)
+#define EMBED_SYMBOL(name) name
+#else
+#define EMBED_SYMBOL(name) _##name
+#endif
+    .section .rdata,"dr"
+#else
+#define EMBED_SYMBOL(name) name
+    .section .note.GNU-stack,"",%progbits
+    .section .rodata
+#endif
+'''
+
+#-------------------------------------------------------------------------------
+def get_cache_dir(out_hdr) :
+    '''
+    Returns the directory where the manifest and the encoded array
+    fragments of an output header are kept.
+    '''
+    return out_hdr + '.embed'
+
+#-------------------------------------------------------------------------------
+def get_fragment_path(cache_dir, entry) :
+    '''
+    Returns the path of the cached, encoded data of a file, or None
+    if the file is included as is by the assembler.
+    '''
+    if entry['format'] == 'incbin' :
+        if entry['encoding'] == 'raw' :
+            return None
+        return '{}/{}.{}.bin'.format(cache_dir, entry['hash'], entry['encoding'])
+    return '{}/{}.{}.{}.txt'.format(cache_dir, entry['hash'], entry['encoding'], entry['format'])
+
+#-------------------------------------------------------------------------------
+def has_fragment(cache_dir, entry) :
+    frag_path = get_fragment_path(cache_dir, entry)
+    return frag_path is None or os.path.isfile(frag_path)
+
+#-------------------------------------------------------------------------------
+def get_file_stat(path) :
+    '''
+    Returns the [size, mtime] pair recorded in the manifest, or None
+    if the file doesn't exist.
+    '''
+    if not path or not os.path.isfile(path) :
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+#-------------------------------------------------------------------------------
+def load_manifest(cache_dir) :
+    '''
+    Load the manifest of a previous run, returns an empty manifest if
+    none exists or it was written by a different generator version.
+    '''
+    try :
+        with open(cache_dir + '/manifest.json', 'r') as f :
+            manifest = json.load(f)
+        if manifest.get('version') == Version :
+            return manifest
+    except (IOError, OSError, ValueError) :
+        pass
+    return { 'version': Version, 'input': None, 'outputs': None, 'shared': None, 'files': {} }
+
+#-------------------------------------------------------------------------------
+def save_manifest(cache_dir, manifest) :
+    with open(cache_dir + '/manifest.json', 'w') as f :
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+#-------------------------------------------------------------------------------
+def check_dirty(input, outputs, file_paths, manifest) :
+    '''
+    Returns True if the YAML file, the output files or any of the
+    embedded files have changed since the manifest was written.
+    '''
+    if manifest['input'] != get_file_stat(input) :
+        return True
+    if manifest['outputs'] != dict((key, get_file_stat(path)) for key, path in outputs.items()) :
+        return True
+    for file_path in file_paths :
+        entry = manifest['files'].get(file_path)
+        if not entry or entry['stat'] != get_file_stat(file_path) :
+            return True
+    return False
+
+#-------------------------------------------------------------------------------
+def map_file(f) :
+    '''
+    Memory-map an open file for reading, the mapping is shared with the
+    page cache instead of copying the whole file into memory.
+    '''
+    if os.fstat(f.fileno()).st_size == 0 :
+        # empty files can't be mapped
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+#-------------------------------------------------------------------------------
+def hash_data(data) :
+    sha1 = hashlib.sha1()
+    view = memoryview(data)
+    for pos in range(0, len(view), ChunkSize) :
+        sha1.update(view[pos:pos+ChunkSize])
+    return sha1.hexdigest()
+
+#-------------------------------------------------------------------------------
+def compress_data(data, path, compress, level) :
+    '''
+    Compress data chunk by chunk into a file as zlib stream, or a raw
+    deflate stream without zlib header and checksum, returns the
+    compressed size.
+    '''
+    if compress == 'deflate' :
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    else :
+        compressor = zlib.compressobj(level)
+    view = memoryview(data)
+    with open(path, 'wb') as f :
+        for pos in range(0, len(view), ChunkSize) :
+            f.write(compressor.compress(view[pos:pos+ChunkSize]))
+        f.write(compressor.flush())
+    return os.path.getsize(path)
+
+#-------------------------------------------------------------------------------
+def move_fragment(tmp_path, frag_path) :
+    '''
+    Move a finished fragment into place, files with identical content
+    share a fragment, so another worker may have been faster.
+    '''
+    if os.path.isfile(frag_path) :
+        os.remove(tmp_path)
+    else :
+        os.rename(tmp_path, frag_path)
+
+#-------------------------------------------------------------------------------
+def write_fragment(frag_path, data, format) :
+    tmp_path = '{}.{}.tmp'.format(frag_path, os.getpid())
+    if format == 'incbin' :
+        with open(tmp_path, 'wb') as f :
+            f.write(data)
+    else :
+        with open(tmp_path, 'w') as f :
+            if format == 'string' :
+                write_string(f, data)
+            else :
+                write_bytes(f, data)
+    move_fragment(tmp_path, frag_path)
+
+#-------------------------------------------------------------------------------
+def is_unchanged(entry, file_stat, compress, level, format) :
+    '''
+    Returns True if a manifest entry is still valid for a file by
+    its size and modification time.
+    '''
+    if entry and entry['compress'] == compress and entry.get('level') == level and entry['format'] == format :
+        return entry['stat'] == file_stat
+    return False
+
+#-------------------------------------------------------------------------------
+def encode_file(job) :
+    '''
+    Returns the manifest entry, a log message, and the time spent reading
+    and encoding an input file, the file is only re-encoded into its
+    fragment if the content, the requested compression (and level) or
+    the output format has changed. Called on the worker processes with a
+    [file_path, cache_dir, entry, compress, level, format] job, level is
+    None for uncompressed files.
+    '''
+    file_path, cache_dir, entry, compress, level, format = job
+    start_time = time.time()
+    file_stat = get_file_stat(file_path)
+    with open(file_path, 'rb') as src_file :
+        file_data = map_file(src_file)
+        try :
+            file_hash = hash_data(file_data)
+            read_time = time.time() - start_time
+            if entry and entry['compress'] == compress and entry.get('level') == level and entry['format'] == format :
+                if entry['hash'] == file_hash and has_fragment(cache_dir, entry) :
+                    entry['stat'] = file_stat
+                    return [entry, None, read_time, 0.0]
+            new_entry = {
+                'stat': file_stat,
+                'size': len(file_data),
+                'hash': file_hash,
+                'compress': compress,
+                'level': level,
+                'encoding': 'raw',
+                'format': format,
+                'stored_size': len(file_data)
+            }
+            if compress :
+                packed_path = '{}/{}.{}.{}.tmp'.format(cache_dir, file_hash, compress, os.getpid())
+                packed_size = compress_data(file_data, packed_path, compress, level)
+                ratio = "{}: {} => {} bytes, {:.1f}%".format(compress,
+                    len(file_data), packed_size, 100.0 * packed_size / max(len(file_data), 1))
+                # store incompressible data as is
+                if packed_size < len(file_data) :
+                    # the level is part of the encoding, so that fragments
+                    # and shared blobs of different levels don't collide
+                    new_entry['encoding'] = '{}{}'.format(compress, level)
+                    new_entry['stored_size'] = packed_size
+                else :
+                    ratio += ', stored uncompressed'
+                msg = "## embed '{}' ({})".format(file_path, ratio)
+            else :
+                msg = "## embed '{}'".format(file_path)
+            frag_path = get_fragment_path(cache_dir, new_entry)
+            if new_entry['encoding'] == 'raw' :
+                if frag_path and not os.path.isfile(frag_path) :
+                    write_fragment(frag_path, file_data, format)
+            elif format == 'incbin' :
+                # the compressed file is included as is
+                move_fragment(packed_path, frag_path)
+            else :
+                with open(packed_path, 'rb') as packed_file :
+                    packed_data = map_file(packed_file)
+                    try :
+                        write_fragment(frag_path, packed_data, format)
+                    finally :
+                        if isinstance(packed_data, mmap.mmap) :
+                            packed_data.close()
+            if compress and os.path.isfile(packed_path) :
+                os.remove(packed_path)
+            return [new_entry, msg, read_time, time.time() - start_time - read_time]
+        finally :
+            if isinstance(file_data, mmap.mmap) :
+                file_data.close()
+
+#-------------------------------------------------------------------------------
+def encode_files(jobs, num_jobs) :
+    '''
+    Encode files on forked worker processes, returns the encode_file()
+    results in the order of the jobs.
+    '''
+    return fipsutil.fork_map(encode_file, jobs, num_jobs)
+
+#-------------------------------------------------------------------------------
+def replace_if_changed(tmp_path, dst_path) :
+    '''
+    Move a freshly written file over its destination, unless the content
+    is identical, in which case the destination isn't touched so that
+    dependent sources are not recompiled.
+    '''
+    if os.path.isfile(dst_path) and filecmp.cmp(tmp_path, dst_path, shallow=False) :
+        os.remove(tmp_path)
+    else :
+        os.replace(tmp_path, dst_path)
+
+#-------------------------------------------------------------------------------
+def get_array_size(entry) :
+    if entry['format'] == 'string' :
+        # one extra byte for the string literal's terminating zero
+        return entry['stored_size'] + 1
+    return entry['stored_size']
+
+#-------------------------------------------------------------------------------
+def get_blob_cname(entry) :
+    '''
+    Returns the C name of a blob in the shared header, derived from the
+    content hash so that it is identical for all headers using the blob,
+    a file embedded in two formats gives two different blobs.
+    '''
+    return 'embed_blob_{}_{}_{}'.format(entry['hash'][:16], entry['encoding'], entry['format'])
+
+#-------------------------------------------------------------------------------
+def write_array(f, cache_dir, file_cname, entry) :
+    '''
+    Write the C array definition of an embedded file for the 'array'
+    and 'string' formats, the data is spliced in from the fragment.
+    '''
+    if entry['format'] == 'string' :
+        f.write('unsigned char {}[{}] =\n'.format(file_cname, get_array_size(entry)))
+    else :
+        f.write('unsigned char {}[{}] = {{\n'.format(file_cname, get_array_size(entry)))
+    with open(get_fragment_path(cache_dir, entry), 'r') as frag :
+        shutil.copyfileobj(frag, f, ChunkSize)
+    if entry['format'] == 'string' :
+        f.write(';\n')
+    else :
+        f.write('\n};\n')
+
+#-------------------------------------------------------------------------------
+def gen_asm(out_asm, file_path, file_cname, cache_dir, entry) :
+    '''
+    Write the assembler .incbin statement of an embedded file.
+    '''
+    frag_path = get_fragment_path(cache_dir, entry)
+    if frag_path is None :
+        frag_path = file_path
+    out_asm.write('    .global EMBED_SYMBOL({})\n'.format(file_cname))
+    out_asm.write('    .balign 16\n')
+    out_asm.write('EMBED_SYMBOL({}):\n'.format(file_cname))
+    out_asm.write('    /* sha1: {} */\n'.format(entry['hash']))
+    out_asm.write('    .incbin "{}"\n'.format(os.path.abspath(frag_path).replace('\\', '/')))
+
+#-------------------------------------------------------------------------------
+def gen_shared(shared_hdr, out_hdr, cache_dir, blobs) :
+    '''
+    Register the blobs of an output header with a shared header (or
+    deregister the output header if blobs is None) and rewrite the shared
+    header with the blobs of all its users. The index of users is kept
+    in the shared header's own cache directory.
+    '''
+    shared_cache_dir = get_cache_dir(shared_hdr)
+    if not os.path.isdir(shared_cache_dir) :
+        os.makedirs(shared_cache_dir)
+    # other generator invocations may update the same index concurrently
+    with fipsutil.lock_file(shared_cache_dir + '/index.lock') :
+        index = load_manifest(shared_cache_dir)
+        users = index.setdefault('users', {})
+        if blobs is None :
+            users.pop(out_hdr, None)
+        else :
+            for blob_cname, entry in blobs.items() :
+                frag_path = get_fragment_path(shared_cache_dir, entry)
+                if not os.path.isfile(frag_path) :
+                    shutil.copyfile(get_fragment_path(cache_dir, entry), frag_path)
+            users[out_hdr] = blobs
+        for user in list(users.keys()) :
+            if not os.path.isfile(user) and user != out_hdr :
+                del users[user]
+
+        # count references across all users, to report what was saved
+        all_blobs = {}
+        saved_bytes = 0
+        for user_blobs in users.values() :
+            for blob_cname, entry in user_blobs.items() :
+                if blob_cname in all_blobs :
+                    saved_bytes += entry['stored_size']
+                else :
+                    all_blobs[blob_cname] = entry
+        tmp_hdr = '{}/header.{}.tmp'.format(shared_cache_dir, os.getpid())
+        with open(tmp_hdr, 'w') as f :
+            f.write('#pragma once\n')
+            f.write('// #version:{}#\n'.format(Version))
+            f.write('// machine generated, do not edit!\n')
+            f.write('// shared embedded data, include in exactly one source file\n')
+            for blob_cname, entry in sorted(all_blobs.items()) :
+                write_array(f, shared_cache_dir, blob_cname, entry)
+        replace_if_changed(tmp_hdr, shared_hdr)
+        print("## embed shared '{}': {} blob(s) for {} header(s), saved {} bytes".format(
+            shared_hdr, len(all_blobs), len(users), saved_bytes))
+
+        # remove fragments of blobs which are no longer used
+        frag_paths = set(get_fragment_path(shared_cache_dir, entry) for entry in all_blobs.values())
+        for frag_name in os.listdir(shared_cache_dir) :
+            frag_path = shared_cache_dir + '/' + frag_name
+            if frag_name.endswith('.txt') and frag_path not in frag_paths :
+                os.remove(frag_path)
+        save_manifest(shared_cache_dir, index)
+
+#-------------------------------------------------------------------------------
+def gen_header(out_hdr, out_asm, shared_hdr, src_dir, files, opts, manifest, profile) :
+    cache_dir = get_cache_dir(out_hdr)
+    prefix = opts['prefix']
+    list_items = opts['list_items']
+    compress = opts['compress']
+    format = opts['format']
+    tmp_hdr = cache_dir + '/header.tmp'
+    tmp_asm = cache_dir + '/source.tmp'
+
+    # encode new and changed files in parallel first, the output is
+    # then written in the original order
+    entries = {}
+    jobs = []
+    for file, file_compress in files :
+        file_path = get_file_path(file, src_dir, out_hdr)
+        if not os.path.isfile(file_path) :
+            genutil.fmtError("Input file not found: '{}'".format(file_path))
+        entry = manifest['files'].get(file_path)
+        file_level = opts['compress_level'] if file_compress else None
+        if is_unchanged(entry, get_file_stat(file_path), file_compress, file_level, format) and has_fragment(cache_dir, entry) :
+            entries[file_path] = entry
+        else :
+            jobs.append([file_path, cache_dir, entry, file_compress, file_level, format])
+    for job, result in zip(jobs, encode_files(jobs, opts['jobs'])) :
+        entry, msg, read_time, encode_time = result
+        if msg :
+            print(msg)
+        entries[job[0]] = entry
+        profile.add_time('read', read_time)
+        profile.add_time('encode', encode_time)
+        profile.count(1, entry['size'])
+    write_start_time = time.time()
+
+    # files with identical content share one array (by content hash),
+    # additional names become aliases of that array
+    arrays = {}
+    blobs = {}
+    num_dups = 0
+    saved_bytes = 0
+    with open(tmp_hdr, 'w') as f:
         f.write('#pragma once\n')
         f.write('// #version:{}#\n'.format(Version))
         f.write('// machine generated, do not edit!\n')
+        if out_asm :
+            # with other formats than 'incbin', the assembler source
+            # declared in the build files is written without data
+            asm = open(tmp_asm, 'w')
+            asm.write(AsmPrologue.format(Version))
+        if format == 'incbin' :
+            f.write('#if defined(__cplusplus)\nextern "C" {\n#endif\n')
         items = {}
-        for file in files :
+        for file, file_compress in files :
             file_path = get_file_path(file, src_dir, out_hdr)
-            print("## embed '{}'".format(file_path))
-            if os.path.isfile(file_path) :
-                with open(file_path, 'rb') as src_file:
-                    file_data = src_file.read()
-                    file_cname = get_file_cname(file, prefix)
-                    file_size = os.path.getsize(file_path)
-                    items[file_cname] = [file, file_size]
-                    f.write('unsigned char {}[{}] = {{\n'.format(file_cname, file_size))               
-                    num = 0
-                    for byte in file_data :
-                        if sys.version_info[0] >= 3:
-                            f.write(hex(ord(chr(byte))) + ', ')
-                        else:
-                            f.write(hex(ord(byte)) + ', ')
-                        num += 1
-                        if 0 == num%16:
-                            f.write('\n')
-                    f.write('\n};\n')
+            entry = entries[file_path]
+            file_cname = get_file_cname(file, prefix)
+            array_key = (entry['hash'], entry['encoding'], entry['format'])
+            if compress :
+                f.write('#define {}_UNPACKED_SIZE ({})\n'.format(file_cname.upper(), entry['size']))
+            if shared_hdr :
+                array_cname = get_blob_cname(entry)
+                if array_key not in arrays :
+                    arrays[array_key] = array_cname
+                    blobs[array_cname] = entry
+                    f.write('extern unsigned char {}[{}];\n'.format(array_cname, get_array_size(entry)))
+                f.write('#define {} {}\n'.format(file_cname, array_cname))
+            elif opts['dedup'] and array_key in arrays :
+                array_cname = arrays[array_key]
+                num_dups += 1
+                saved_bytes += entry['stored_size']
+                f.write('#define {} {}\n'.format(file_cname, array_cname))
             else :
-                genutil.fmtError("Input file not found: '{}'".format(file_path))
+                array_cname = file_cname
+                arrays[array_key] = array_cname
+                if format == 'incbin' :
+                    f.write('extern const unsigned char {}[{}];\n'.format(file_cname, entry['stored_size']))
+                    gen_asm(asm, file_path, file_cname, cache_dir, entry)
+                else :
+                    write_array(f, cache_dir, file_cname, entry)
+            items[file_cname] = [file, entry['stored_size'], entry['size'], array_cname]
+        if format == 'incbin' :
+            f.write('#if defined(__cplusplus)\n}\n#endif\n')
+        if out_asm :
+            asm.close()
         if list_items:
-            f.write('typedef struct {{ const char* name; const uint8_t* ptr; int size; }} {}item_t;\n'.format(prefix))
+            if compress :
+                f.write('typedef struct {{ const char* name; const uint8_t* ptr; int size; int unpacked_size; }} {}item_t;\n'.format(prefix))
+            else :
+                f.write('typedef struct {{ const char* name; const uint8_t* ptr; int size; }} {}item_t;\n'.format(prefix))
             f.write('#define {}NUM_ITEMS ({})\n'.format(prefix.upper(), len(items)))
             f.write('{}item_t {}items[{}NUM_ITEMS] = {{\n'.format(prefix, prefix, prefix.upper()))
             for name,item in sorted(items.items()):
@@ -99,23 +646,127 @@ def gen_header(out_hdr, src_dir, files, prefix, list_items) :
                 text = name[(len(prefix)):]
                 if 'full' == list_items:
                     text = item[0]
-                f.write('{{ "{}", {}, {} }},\n'.format(text, name, size))
+                if compress :
+                    f.write('{{ "{}", {}, {}, {} }},\n'.format(text, item[3], size, item[2]))
+                else :
+                    f.write('{{ "{}", {}, {} }},\n'.format(text, item[3], size))
             f.write('};\n')
+    replace_if_changed(tmp_hdr, out_hdr)
+    if out_asm :
+        replace_if_changed(tmp_asm, out_asm)
+    if num_dups > 0 :
+        print("## embed '{}': {} duplicate file(s), saved {} bytes".format(out_hdr, num_dups, saved_bytes))
+    if shared_hdr :
+        gen_shared(shared_hdr, out_hdr, cache_dir, blobs)
+    profile.add_time('write', time.time() - write_start_time)
+
+    # remove fragments of files which are no longer embedded
+    frag_paths = set(get_fragment_path(cache_dir, entry) for entry in entries.values())
+    for frag_name in os.listdir(cache_dir) :
+        frag_path = cache_dir + '/' + frag_name
+        if frag_name.endswith(('.txt', '.bin')) and frag_path not in frag_paths :
+            os.remove(frag_path)
+    manifest['files'] = entries
+
+#-------------------------------------------------------------------------------
+def get_files(desc, compress) :
+    '''
+    Returns the list of [file name, compression] pairs, files can either
+    be listed by name, or as '{ file: name, compress: false }'.
+    '''
+    files = []
+    for item in desc['files'] :
+        if isinstance(item, dict) :
+            if 'file' not in item :
+                genutil.fmtError("Missing 'file' in files entry: '{}'".format(item))
+            file_compress = compress
+            if 'compress' in item and not item['compress'] :
+                file_compress = None
+            files.append([item['file'], file_compress])
+        else :
+            files.append([item, compress])
+    return files
+
+#-------------------------------------------------------------------------------
+def get_options(desc) :
+    '''
+    Returns the generator options from the YAML description, with
+    defaults for options which are not provided.
+    '''
+    opts = {
+        'prefix': 'embed_',
+        'src_dir': '',
+        'list_items': False,
+        'compress': None,
+        'compress_level': 9,
+        'format': 'array',
+        'jobs': multiprocessing.cpu_count(),
+        'dedup': False,
+        'shared': None,
+        'profile': False
+    }
+    if 'options' in desc:
+        opts.update(desc['options'])
+    if opts['src_dir'] :
+        opts['src_dir'] += '/'
+    if not opts['compress'] :
+        opts['compress'] = None
+    elif opts['compress'] not in ['zlib', 'deflate'] :
+        genutil.fmtError("Invalid compress option '{}' (must be 'zlib' or 'deflate')".format(opts['compress']))
+    if opts['format'] not in ['array', 'string', 'incbin'] :
+        genutil.fmtError("Invalid format option '{}' (must be 'array', 'string' or 'incbin')".format(opts['format']))
+    if opts['shared'] and opts['format'] == 'incbin' :
+        genutil.fmtError("option 'shared' can't be used with format 'incbin'")
+    return opts
+
+#-------------------------------------------------------------------------------
+def validate(desc) :
+    opts = get_options(desc)
+    return { 'opts': opts, 'files': get_files(desc, opts['compress']) }
 
 #-------------------------------------------------------------------------------
 def generate(input, out_src, out_hdr) :
-    if genutil.isDirty(Version, [input], [out_hdr]) :
-        with open(input, 'r') as f :
-            desc = yaml.load(f)
-        prefix = 'embed_'
-        src_dir = ''
-        list_items = False
-        if 'options' in desc:
-            opts = desc['options']
-            if 'prefix' in opts:
-                prefix = opts['prefix']
-            if 'src_dir' in opts:
-                src_dir = opts['src_dir'] + '/'
-            if 'list_items' in opts:
-                list_items = opts['list_items']
-        gen_header(out_hdr, src_dir, desc['files'], prefix, list_items)
+    profile = fipsutil.Profile('embed', input)
+    try :
+        gen_embed(input, out_src, out_hdr, profile)
+    finally :
+        profile.finish()
+
+#-------------------------------------------------------------------------------
+def gen_embed(input, out_src, out_hdr, profile) :
+    with profile.phase('yaml') :
+        config = fipsutil.load_config(input, validate, 'embed:{}'.format(Version))
+    opts = config['opts']
+    files = config['files']
+    if opts['profile'] :
+        profile.enable()
+    # the assembler source must be preprocessed, which GCC and Clang only
+    # do for the '.S' extension
+    out_asm = None
+    if out_src and os.path.splitext(out_src)[1] == '.S' :
+        out_asm = out_src
+    elif out_src and os.path.splitext(out_src)[1] in ['.s', '.asm'] :
+        genutil.fmtError("assembler source '{}' must have the extension '.S'".format(out_src))
+    if opts['format'] == 'incbin' and not out_asm :
+        genutil.fmtError("format 'incbin' requires an assembler source, use 'fipsutil_embed(src.yml dst.h dst.S)'")
+    shared_hdr = None
+    if opts['shared'] :
+        shared_hdr = os.path.normpath(get_file_path(opts['shared'], '', out_hdr)).replace('\\', '/')
+    src_dir = opts['src_dir']
+    cache_dir = get_cache_dir(out_hdr)
+    if not os.path.isdir(cache_dir) :
+        os.makedirs(cache_dir)
+    manifest = load_manifest(cache_dir)
+    outputs = { 'header': out_hdr, 'source': out_asm, 'shared': shared_hdr }
+    file_paths = [get_file_path(file, src_dir, out_hdr) for file, _ in files]
+    with profile.phase('dirty') :
+        dirty = check_dirty(input, outputs, file_paths, manifest)
+    if dirty :
+        gen_header(out_hdr, out_asm, shared_hdr, src_dir, files, opts, manifest, profile)
+        # the header moved to another shared header, or doesn't use one anymore
+        if manifest.get('shared') and manifest['shared'] != shared_hdr :
+            gen_shared(manifest['shared'], out_hdr, cache_dir, None)
+        manifest['shared'] = shared_hdr
+        manifest['input'] = get_file_stat(input)
+        manifest['outputs'] = dict((key, get_file_stat(path)) for key, path in outputs.items())
+        save_manifest(cache_dir, manifest)
@@ -0,0 +1,275 @@
+'''
+    fipsutil.py
+
+    Shared runtime helpers for the fips-utils generators (not a generator
+    itself).
+
+    load_config() parses a generator's YAML file with the libyaml based
+    CSafeLoader if available (falling back to the pure Python SafeLoader),
+    and caches the parsed (and optionally validated) result on disk, keyed
+    by the YAML file's path, modification time and size, so that unchanged
+    YAML files are never parsed again.
+
+    The cache is located in the directory given by the environment variable
+    FIPSUTIL_CACHE_DIR, or in a per-user directory under the system's temp
+    directory. Cache entries are stored as JSON (configs which don't survive
+    a JSON round trip are not cached), and the cache directory is only used
+    if it is owned by the current user and not writable by anybody else.
+
+    Profile is an opt-in instrumentation of a generator invocation, which
+    records the time spent in each phase (YAML parsing, dirty checking,
+    reading, encoding and writing) and the number of processed files and
+    bytes. It is enabled by setting the environment variable FIPSUTIL_PROFILE
+    (to '1', or to the path of a .jsonl report file), or by the generator's
+    YAML option 'profile: true'. Each invocation appends one JSON line to
+    'fipsutil-report.jsonl' in the current directory (which is the build
+    directory when run by the build system). Use 'fips genstats' to rank
+    the slowest generator steps of a project.
+
+    fork_map() runs a function over a list of items on forked worker
+    processes, see forkutil.py.
+
+    lock_file() serializes read-modify-write updates of files which are
+    shared by several generator invocations (which may run in parallel).
+'''
+
+import os
+import time
+import json
+import contextlib
+import hashlib
+import stat
+import getpass
+import tempfile
+import yaml
+import genutil
+import forkutil
+try :
+    import fcntl
+except ImportError :
+    fcntl = None
+    import msvcrt
+
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+# bump when the cache layout changes
+CacheVersion = 2
+
+# file name of the profiling reports
+ReportName = 'fipsutil-report.jsonl'
+
+#-------------------------------------------------------------------------------
+def get_cache_dir() :
+    cache_dir = os.environ.get('FIPSUTIL_CACHE_DIR')
+    if not cache_dir :
+        try :
+            user = getpass.getuser()
+        except Exception :
+            user = 'default'
+        cache_dir = os.path.join(tempfile.gettempdir(), 'fipsutil-cache-{}'.format(user))
+    return cache_dir
+
+#-------------------------------------------------------------------------------
+def get_cache_path(path, tag) :
+    key = '{}|{}'.format(os.path.abspath(path), tag)
+    return os.path.join(get_cache_dir(), hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+#-------------------------------------------------------------------------------
+def is_trusted_dir(path) :
+    '''
+    Returns True if a cache directory exists, is owned by the current user
+    and isn't writable by other users (who could plant cache entries),
+    symlinks are followed, since their target is checked.
+    '''
+    try :
+        st = os.stat(path)
+    except OSError :
+        return False
+    if not stat.S_ISDIR(st.st_mode) :
+        return False
+    if hasattr(os, 'getuid') :
+        return st.st_uid == os.getuid() and not (st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+    return True
+
+#-------------------------------------------------------------------------------
+def ensure_cache_dir(cache_dir) :
+    '''
+    Create the cache directory (only accessible by the current user) if
+    it doesn't exist, returns False if it can't be used.
+    '''
+    if not os.path.exists(cache_dir) :
+        try :
+            os.makedirs(cache_dir, 0o700)
+        except OSError :
+            return False
+    if not is_trusted_dir(cache_dir) :
+        print("## fipsutil: ignoring cache directory '{}' (must be owned by the current user and not writable by others)".format(cache_dir))
+        return False
+    return True
+
+#-------------------------------------------------------------------------------
+def parse_yaml(path) :
+    '''
+    Parse a YAML file, YAML errors are reported with their location.
+    '''
+    with open(path, 'r') as f :
+        try :
+            return yaml.load(f, Loader=YamlLoader)
+        except yaml.YAMLError as exc :
+            # show a proper error if YAML parsing fails
+            if getattr(exc, 'problem_mark', None) :
+                genutil.setErrorLocation(exc.problem_mark.name, exc.problem_mark.line-1)
+            genutil.fmtError('YAML error: {}'.format(getattr(exc, 'problem', exc)))
+
+#-------------------------------------------------------------------------------
+def load_config(path, validate=None, tag='') :
+    '''
+    Returns the content of a YAML file, passed through the optional
+    validate function. The result is taken from the on-disk cache if
+    the YAML file hasn't changed. The tag identifies the validation
+    (for instance generator name and version), so that each generator
+    gets its own cache entry.
+    '''
+    st = os.stat(path)
+    key = [CacheVersion, tag, st.st_size, st.st_mtime]
+    cache_path = get_cache_path(path, tag)
+    use_cache = ensure_cache_dir(os.path.dirname(cache_path))
+    if use_cache :
+        try :
+            with open(cache_path, 'r') as f :
+                entry = json.load(f)
+            if entry['key'] == key :
+                return entry['config']
+        except Exception :
+            # a missing or unreadable cache entry is a cache miss
+            pass
+    config = parse_yaml(path)
+    if validate :
+        config = validate(config)
+    if use_cache :
+        try :
+            text = json.dumps({ 'key': key, 'config': config })
+            # YAML can produce values which JSON can't represent exactly
+            # (like non-string keys), those configs are not cached
+            if json.loads(text)['config'] == config :
+                tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+                with open(tmp_path, 'w') as f :
+                    f.write(text)
+                os.replace(tmp_path, cache_path)
+        except (IOError, OSError, TypeError, ValueError) :
+            # not being able to write the cache is not an error
+            pass
+    return config
+
+#-------------------------------------------------------------------------------
+def get_report_path() :
+    '''
+    Returns the path of the profiling report file, or None if profiling
+    isn't enabled through the FIPSUTIL_PROFILE environment variable.
+    '''
+    value = os.environ.get('FIPSUTIL_PROFILE', '')
+    if value in ['', '0'] :
+        return None
+    if value.endswith('.jsonl') :
+        return os.path.abspath(value)
+    return os.path.join(os.getcwd(), ReportName)
+
+#-------------------------------------------------------------------------------
+class Profile(object) :
+    '''
+    Records phase timings and file/byte counts of one generator invocation.
+    Recording is cheap and always done, the record is only written if
+    profiling is enabled.
+    '''
+    def __init__(self, generator, input) :
+        self.report_path = get_report_path()
+        self.start_time = time.time()
+        self.record = {
+            'generator': generator,
+            'input': os.path.abspath(input),
+            'phases': {},
+            'files': 0,
+            'bytes': 0
+        }
+
+    def enable(self) :
+        '''
+        Enable profiling from a generator option.
+        '''
+        if not self.report_path :
+            self.report_path = os.path.join(os.getcwd(), ReportName)
+
+    @contextlib.contextmanager
+    def phase(self, name) :
+        start = time.time()
+        try :
+            yield
+        finally :
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds) :
+        phases = self.record['phases']
+        phases[name] = phases.get(name, 0.0) + seconds
+
+    def count(self, files, num_bytes) :
+        self.record['files'] += files
+        self.record['bytes'] += num_bytes
+
+    def finish(self) :
+        '''
+        Append the record to the report file if profiling is enabled.
+        '''
+        if not self.report_path :
+            return
+        self.record['time'] = time.time() - self.start_time
+        self.record['timestamp'] = self.start_time
+        try :
+            # a single short write in append mode, so that concurrent
+            # generators don't interleave their records
+            with open(self.report_path, 'a') as f :
+                f.write(json.dumps(self.record, sort_keys=True) + '\n')
+        except (IOError, OSError) as err :
+            print("## fipsutil: failed to write profile report '{}': {}".format(self.report_path, err))
+
+#-------------------------------------------------------------------------------
+@contextlib.contextmanager
+def lock_file(path) :
+    '''
+    Holds an exclusive lock on a lock file (which is created if needed)
+    for the duration of a with-block, waits until the lock is available.
+    '''
+    with open(path, 'a+') as f :
+        if fcntl :
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else :
+            # LK_LOCK gives up after 10 seconds, keep waiting
+            f.seek(0)
+            while True :
+                try :
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError :
+                    pass
+        try :
+            yield
+        finally :
+            if fcntl :
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else :
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+#-------------------------------------------------------------------------------
+def fork_map(func, items, num_jobs) :
+    '''
+    Returns [func(item) for item in items], computed on up to num_jobs
+    forked worker processes (see forkutil.py), failed workers are reported
+    as generator errors.
+    '''
+    try :
+        return forkutil.fork_map(func, items, num_jobs)
+    except forkutil.WorkerError as err :
+        genutil.fmtError(str(err))
@@ -0,0 +1,74 @@
+'''
+    forkutil.py
+
+    Runs a function over a list of items on forked worker processes (not
+    a generator itself). Only depends on the standard library, so that it
+    can be used by the generators (through fipsutil.fork_map()) and by the
+    verbs, which load it by file path.
+
+    Generators and verbs are loaded by file path and can't be imported by
+    name, so their functions can't be pickled for a multiprocessing pool.
+    fork_map() lets the workers inherit the function through fork()
+    instead, only the items and results are pickled.
+'''
+
+import traceback
+import multiprocessing
+
+#-------------------------------------------------------------------------------
+class WorkerError(RuntimeError) :
+    '''
+    Raised by fork_map() if a worker process failed, the message contains
+    the formatted exceptions of the workers.
+    '''
+    pass
+
+#-------------------------------------------------------------------------------
+def fork_worker(func, items, conn) :
+    '''
+    Runs on a forked worker process, sends the results of func(), or the
+    formatted exception, back to the parent.
+    '''
+    try :
+        conn.send([None, [func(item) for item in items]])
+    except BaseException :
+        conn.send([traceback.format_exc(), None])
+    finally :
+        conn.close()
+
+#-------------------------------------------------------------------------------
+def fork_map(func, items, num_jobs) :
+    '''
+    Returns [func(item) for item in items], computed on up to num_jobs
+    forked worker processes. Runs on the calling process if there's not
+    enough work, or processes can't be forked.
+    '''
+    num_jobs = min(num_jobs, len(items))
+    if num_jobs < 2 or 'fork' not in multiprocessing.get_all_start_methods() :
+        return [func(item) for item in items]
+    ctx = multiprocessing.get_context('fork')
+    workers = []
+    for i in range(num_jobs) :
+        recv_conn, send_conn = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=fork_worker, args=(func, items[i::num_jobs], send_conn))
+        proc.start()
+        # close the parent's sending end, so that recv() fails instead
+        # of blocking forever if the worker dies
+        send_conn.close()
+        workers.append([proc, recv_conn])
+    results = [None] * len(items)
+    errors = []
+    for i, (proc, recv_conn) in enumerate(workers) :
+        try :
+            error, worker_results = recv_conn.recv()
+        except EOFError :
+            error, worker_results = 'worker process terminated unexpectedly', None
+        recv_conn.close()
+        proc.join()
+        if error :
+            errors.append(error)
+        else :
+            results[i::num_jobs] = worker_results
+    if errors :
+        raise WorkerError('worker process failed:\n{}'.format('\n'.join(errors)))
+    return results
@@ -20,8 +20,21 @@ endmacro()
 #   Convert a binary file into a C array in a header, the header is generated
 #   in the project directory next to the yml file.
 #
-#   Also see fips-files/generators/incbin.py
+#   With the 'format: incbin' option, an additional assembler source
+#   file name (with the extension .S) must be provided which includes
+#   the binary data:
+#
+#   fipsutil_embed(yml_file hdr_name asm_name)
+#
+#   With other formats, the assembler source is generated without data.
+#
+#   Also see fips-files/generators/embed.py
 #
 macro(fipsutil_embed yml_file hdr_name)
-    fips_generate(FROM ${yml_file} TYPE embed HEADER ${hdr_name})
+    if (${ARGC} GREATER 2)
+        enable_language(ASM)
+        fips_generate(FROM ${yml_file} TYPE embed HEADER ${hdr_name} SOURCE ${ARGV2})
+    else()
+        fips_generate(FROM ${yml_file} TYPE embed HEADER ${hdr_name})
+    endif()
 endmacro()
@@ -0,0 +1,241 @@
+"""implement 'bench' verb (benchmarks a single target)
+
+bench
+bench [target]
+bench [target] [config]
+bench [target] [config] [--runs=N] [--warmup=N] [--threshold=percent]
+      [--baseline=file] [--save-baseline=file] [-- args]
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import subprocess
+
+from mod import log, util, config, settings
+
+# the measured values of each run, max RSS is None where os.wait4 isn't available
+Metrics = [ 'wall', 'user', 'sys', 'maxrss' ]
+
+# bump when the baseline layout changes
+BaselineVersion = 1
+
+#-------------------------------------------------------------------------------
+def run_once(deploy_dir, target, target_args) :
+    """run the target once, returns a dict with wall time, user and system
+    CPU time in seconds, and max RSS in bytes"""
+    cmd = [ './{}'.format(target) ] + target_args
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd = deploy_dir, stdout = subprocess.DEVNULL)
+    if hasattr(os, 'wait4') :
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        # reap the process in the Popen object too
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+        maxrss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+        sample = { 'wall': wall, 'user': usage.ru_utime, 'sys': usage.ru_stime, 'maxrss': maxrss }
+    else :
+        proc.wait()
+        sample = { 'wall': time.perf_counter() - start, 'user': None, 'sys': None, 'maxrss': None }
+    if proc.returncode != 0 :
+        log.error("'{}' failed with exit code {}".format(target, proc.returncode))
+    return sample
+
+#-------------------------------------------------------------------------------
+def percentile(values, p) :
+    """linear interpolation percentile of sorted values"""
+    pos = (len(values) - 1) * p / 100.0
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+#-------------------------------------------------------------------------------
+def median_ci(values, resamples = 2000) :
+    """95% confidence interval of the median, bootstrapped with a fixed seed
+    so that the same samples always give the same interval"""
+    rnd = random.Random(0)
+    n = len(values)
+    medians = sorted(percentile(sorted(rnd.choice(values) for _ in range(n)), 50) for _ in range(resamples))
+    return percentile(medians, 2.5), percentile(medians, 97.5)
+
+#-------------------------------------------------------------------------------
+def summarize(samples) :
+    """compute the statistics of each metric over all runs"""
+    stats = {}
+    for metric in Metrics :
+        values = sorted(s[metric] for s in samples if s[metric] is not None)
+        if not values :
+            stats[metric] = None
+            continue
+        mean = sum(values) / len(values)
+        stdev = math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1)) if len(values) > 1 else 0.0
+        ci_low, ci_high = median_ci(values)
+        stats[metric] = {
+            'median': percentile(values, 50),
+            'mean': mean,
+            'stdev': stdev,
+            'min': values[0],
+            'max': values[-1],
+            'p10': percentile(values, 10),
+            'p90': percentile(values, 90),
+            'ci_low': ci_low,
+            'ci_high': ci_high
+        }
+    return stats
+
+#-------------------------------------------------------------------------------
+def fmt_value(metric, value) :
+    if metric == 'maxrss' :
+        return '{:.1f} MB'.format(value / (1024.0 * 1024.0))
+    return '{:.2f} ms'.format(value * 1000.0)
+
+#-------------------------------------------------------------------------------
+def print_stats(stats) :
+    fmt = '{:<8} {:>12} {:>12} {:>12} {:>12} {:>12} {:>27}'
+    log.colored(log.YELLOW, fmt.format('', 'median', 'mean', 'p10', 'p90', 'max', '95% CI of median'))
+    for metric in Metrics :
+        s = stats[metric]
+        if s :
+            log.info(fmt.format(metric, fmt_value(metric, s['median']), fmt_value(metric, s['mean']),
+                fmt_value(metric, s['p10']), fmt_value(metric, s['p90']), fmt_value(metric, s['max']),
+                '{} .. {}'.format(fmt_value(metric, s['ci_low']), fmt_value(metric, s['ci_high']))))
+
+#-------------------------------------------------------------------------------
+def find_regressions(stats, base, threshold) :
+    """a metric regressed if its median grew by more than threshold percent
+    and the confidence intervals of old and new median don't overlap"""
+    regressions = []
+    for metric in Metrics :
+        new, old = stats[metric], base.get(metric)
+        if not new or not old or not old['median'] :
+            continue
+        change = (new['median'] - old['median']) * 100.0 / old['median']
+        if change > threshold and new['ci_low'] > old['ci_high'] :
+            regressions.append('{}: {} => {} ({:+.1f}%)'.format(metric,
+                fmt_value(metric, old['median']), fmt_value(metric, new['median']), change))
+    return regressions
+
+#-------------------------------------------------------------------------------
+def load_baseline(path) :
+    try :
+        with open(path, 'r') as f :
+            baseline = json.load(f)
+    except (IOError, OSError, ValueError) as err :
+        log.error("failed to load baseline '{}': {}".format(path, err))
+    if baseline.get('version') != BaselineVersion :
+        log.error("baseline '{}' has an incompatible version".format(path))
+    return baseline
+
+#-------------------------------------------------------------------------------
+def bench(fips_dir, proj_dir, cfg_name, target, target_args, opts) :
+    """benchmark a single target"""
+
+    # prepare
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    util.ensure_valid_project_dir(proj_dir)
+    baseline = load_baseline(opts['baseline']) if opts['baseline'] else None
+    results = {}
+    regressions = []
+
+    # load the config(s)
+    configs = config.load(fips_dir, proj_dir, cfg_name)
+    if configs :
+        for cfg in configs :
+            # check if config is valid
+            config_valid, _ = config.check_config_valid(fips_dir, proj_dir, cfg, print_errors = True)
+            if config_valid :
+                deploy_dir = util.get_deploy_dir(fips_dir, proj_name, cfg['name'])
+                if not os.path.isfile(os.path.join(deploy_dir, target)) :
+                    log.error("target '{}' not found in '{}'".format(target, deploy_dir))
+                log.colored(log.YELLOW, "=== bench: {} ({} warmup, {} runs)".format(cfg['name'], opts['warmup'], opts['runs']))
+                for _ in range(opts['warmup']) :
+                    run_once(deploy_dir, target, target_args)
+                samples = [run_once(deploy_dir, target, target_args) for _ in range(opts['runs'])]
+                stats = summarize(samples)
+                print_stats(stats)
+                key = '{}/{}'.format(cfg['name'], target)
+                results[key] = { 'args': target_args, 'runs': opts['runs'], 'stats': stats }
+                if baseline :
+                    if key in baseline['results'] :
+                        for regression in find_regressions(stats, baseline['results'][key]['stats'], opts['threshold']) :
+                            regressions.append('{}: {}'.format(key, regression))
+                    else :
+                        log.warn("no baseline for '{}'".format(key))
+            else :
+                log.error("Config '{}' not valid in this environment".format(cfg['name']))
+    else :
+        log.error("No valid configs found for '{}'".format(cfg_name))
+
+    if opts['save-baseline'] :
+        # merge into an existing baseline, so that several targets can share one file
+        path = opts['save-baseline']
+        saved = load_baseline(path) if os.path.isfile(path) else { 'version': BaselineVersion, 'results': {} }
+        saved['results'].update(results)
+        with open(path, 'w') as f :
+            json.dump(saved, f, indent=2, sort_keys=True)
+        log.info("baseline written to '{}'".format(path))
+    if regressions :
+        for regression in regressions :
+            log.colored(log.RED, regression)
+        log.error('{} benchmark regression(s) above {}%'.format(len(regressions), opts['threshold']))
+    return True
+
+#-------------------------------------------------------------------------------
+def run(fips_dir, proj_dir, args) :
+    """benchmark a single target"""
+    if not util.is_valid_project_dir(proj_dir) :
+        log.error('must be run in a project directory')
+    tgt_name = None
+    cfg_name = None
+    target_args = []
+    if '--' in args :
+        idx = args.index('--')
+        target_args = args[(idx + 1):]
+        args = args[:idx]
+    opts = { 'runs': 10, 'warmup': 1, 'threshold': 5.0, 'baseline': None, 'save-baseline': None }
+    positional = []
+    for arg in args :
+        if arg.startswith('--') :
+            key, _, value = arg[2:].partition('=')
+            if key not in opts or not value :
+                log.error("invalid option '{}'".format(arg))
+            opts[key] = value
+        else :
+            positional.append(arg)
+    opts['runs'] = int(opts['runs'])
+    opts['warmup'] = int(opts['warmup'])
+    opts['threshold'] = float(opts['threshold'])
+    if opts['runs'] < 1 :
+        log.error('need at least one run')
+    if len(positional) > 0 :
+        tgt_name = positional[0]
+    if len(positional) > 1 :
+        cfg_name = positional[1]
+    if not cfg_name :
+        cfg_name = settings.get(proj_dir, 'config')
+    if not tgt_name :
+        tgt_name = settings.get(proj_dir, 'target')
+    if not tgt_name :
+        log.error('no target specified')
+    bench(fips_dir, proj_dir, cfg_name, tgt_name, target_args, opts)
+
+#-------------------------------------------------------------------------------
+def help() :
+    """print 'bench' help"""
+    log.info(log.YELLOW +
+            "fips bench [-- args]\n"
+            "fips bench [target] [-- args]\n"
+            "fips bench [target] [config] [-- args]\n"
+            "    [--runs=N] [--warmup=N] [--baseline=file] [--save-baseline=file]\n"
+            "    [--threshold=percent]\n" + log.DEF +
+            "    run a single target N times (default 10, after 1 warmup run) in\n"
+            "    current or named config and print median, mean, percentiles and\n"
+            "    the 95% confidence interval of the median of wall time, user and\n"
+            "    system CPU time and max RSS; --save-baseline stores the results\n"
+            "    in a JSON file, --baseline fails if a median grew by more than\n"
+            "    the threshold (default 5%) and the confidence intervals don't\n"
+            "    overlap")
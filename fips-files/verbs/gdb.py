@@ -3,12 +3,51 @@
 gdb
 gdb [target]
 gdb [target] [config]
+gdb --batch [target ...|all] [--config=cfg] [--jobs=N] [--timeout=sec] [-- args]
 """
 
+import os
+import re
+import json
+import signal
+import hashlib
 import subprocess
+import importlib.util
+import concurrent.futures
 
 from mod import log, util, config, project, settings
 
+#-------------------------------------------------------------------------------
+def load_batchutil() :
+    # shared with the 'valgrind' verb, loaded by file path since every
+    # module in the verbs directory is loaded as a verb
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'generators', 'batchutil.py')
+    spec = importlib.util.spec_from_file_location('batchutil', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+batchutil = load_batchutil()
+
+# gdb commands of a batch session, the output of each section is
+# preceded by a '=== [section] ===' marker line
+BatchSections = [
+    ('backtrace', 'bt full'),
+    ('registers', 'info registers'),
+    ('threads', 'thread apply all bt')
+]
+
+# frames of the signal and assert machinery, skipped in crash signatures
+IgnoredFrames = set([ 'raise', 'abort', 'gsignal', 'pthread_kill', '__pthread_kill_implementation',
+    '__pthread_kill_internal', '__assert_fail', '__assert_fail_base', '__libc_message',
+    '__malloc_assert', 'malloc_printerr', '__abort_with_payload', '__pthread_kill' ])
+
+# number of frames in a crash signature
+SignatureFrames = 5
+
+CrashSignal = re.compile(r'Program (?:received|terminated with) signal (\w+)')
+ExitCode = re.compile(r'exited with code (\d+)')
+FrameLine = re.compile(r'^#\d+\s+(?:0x[0-9a-fA-F]+ in )?(\S.*?) \(')
+
 #-------------------------------------------------------------------------------
 def gdb(fips_dir, proj_dir, cfg_name, target=None, target_args=None) :
     """debug a single target with gdb"""
@@ -40,6 +79,185 @@ def gdb(fips_dir, proj_dir, cfg_name, target=None, target_args=None) :
 
     return True
 
+#-------------------------------------------------------------------------------
+def get_log_dir(fips_dir, proj_name, cfg_name) :
+    """per-config directory for gdb batch logs"""
+    return util.get_build_dir(fips_dir, proj_name, cfg_name) + '/gdb'
+
+#-------------------------------------------------------------------------------
+def get_report_dir(fips_dir, proj_dir) :
+    # crash reports go to 'fips-deploy/[proj]-crashes', next to markdeep's output
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    return util.get_workspace_dir(fips_dir) + '/fips-deploy/' + proj_name + '-crashes'
+
+#-------------------------------------------------------------------------------
+def split_sections(output) :
+    """split a batch session's output at the section markers"""
+    sections = { 'run': [] }
+    current = sections['run']
+    for line in output.splitlines() :
+        if line.startswith('=== ') and line.endswith(' ===') :
+            current = sections.setdefault(line[4:-4], [])
+        else :
+            current.append(line)
+    return sections
+
+#-------------------------------------------------------------------------------
+def normalize_frame(name) :
+    if name.startswith('__GI_') :
+        name = name[5:]
+    return name
+
+#-------------------------------------------------------------------------------
+def get_signature(sig, backtrace) :
+    """the signal and the top frames of the crashing thread, without the
+    frames of the signal and assert machinery"""
+    frames = []
+    for line in backtrace :
+        m = FrameLine.match(line)
+        if m :
+            name = normalize_frame(m.group(1))
+            if name not in IgnoredFrames :
+                frames.append(name)
+                if len(frames) == SignatureFrames :
+                    break
+    return sig, frames
+
+#-------------------------------------------------------------------------------
+def run_session(job) :
+    """run one target of one config under gdb -batch, returns the result"""
+    gdb_bin, deploy_dir, log_dir, cfg_name, target, target_args, timeout = job
+    result = {
+        'config': cfg_name,
+        'target': target,
+        'log': '{}/{}.log'.format(log_dir, target),
+        'signal': None,
+        'frames': []
+    }
+    if not os.path.isfile(os.path.join(deploy_dir, target)) :
+        result['status'] = 'missing'
+        return result
+    cmd = [ gdb_bin, '-batch', '-nx', '-ex', 'set pagination off', '-ex', 'set confirm off', '-ex', 'run' ]
+    for section, command in BatchSections :
+        cmd += [ '-ex', 'echo \\n=== {} ===\\n'.format(section), '-ex', command ]
+    cmd += [ '--args', './{}'.format(target) ] + target_args
+    try :
+        # a new session, so that a hanging gdb can be killed with its inferior
+        proc = subprocess.Popen(cmd, cwd = deploy_dir, stdin = subprocess.DEVNULL,
+            stdout = subprocess.PIPE, stderr = subprocess.STDOUT, start_new_session = True)
+    except OSError :
+        result['status'] = 'failed to execute gdb'
+        return result
+    try :
+        output, _ = proc.communicate(timeout = timeout)
+    except subprocess.TimeoutExpired :
+        os.killpg(proc.pid, signal.SIGKILL)
+        output, _ = proc.communicate()
+        result['status'] = 'timeout'
+    output = output.decode('utf-8', errors = 'replace')
+    with open(result['log'], 'w') as f :
+        f.write(output)
+    if result.get('status') == 'timeout' :
+        return result
+
+    sections = split_sections(output)
+    m = CrashSignal.search('\n'.join(sections['run']))
+    if m :
+        result['status'] = 'crash'
+        result['signal'], result['frames'] = get_signature(m.group(1), sections.get('backtrace', []))
+        result['backtrace'] = sections.get('backtrace', [])
+    elif 'exited normally' in output :
+        result['status'] = 'ok'
+    else :
+        m = ExitCode.search(output)
+        result['status'] = 'exit {}'.format(int(m.group(1), 8)) if m else 'unknown'
+    return result
+
+#-------------------------------------------------------------------------------
+def group_crashes(results) :
+    """collapse crashes with the same signature, most frequent first"""
+    groups = {}
+    for res in results :
+        if res['status'] != 'crash' :
+            continue
+        signature = '{}: {}'.format(res['signal'], ' < '.join(res['frames']) or '??')
+        if signature not in groups :
+            groups[signature] = {
+                'id': hashlib.sha1(signature.encode('utf-8')).hexdigest()[:12],
+                'signature': signature,
+                'signal': res['signal'],
+                'frames': res['frames'],
+                'backtrace': res['backtrace'],
+                'runs': []
+            }
+        groups[signature]['runs'].append({ 'config': res['config'], 'target': res['target'], 'log': res['log'] })
+    return sorted(groups.values(), key = lambda g: (-len(g['runs']), g['signature']))
+
+#-------------------------------------------------------------------------------
+def write_report(report_dir, results, groups) :
+    """write the crash groups as crashes.json and crashes.md"""
+    if not os.path.isdir(report_dir) :
+        os.makedirs(report_dir)
+    runs = [{ key: res[key] for key in ['config', 'target', 'status', 'log'] } for res in results]
+    with open(report_dir + '/crashes.json', 'w') as f :
+        json.dump({ 'runs': runs, 'groups': groups }, f, indent = 2)
+    with open(report_dir + '/crashes.md', 'w') as f :
+        num_crashes = sum(len(g['runs']) for g in groups)
+        f.write('# Crash report\n\n')
+        f.write('{} run(s), {} crash(es), {} unique\n\n'.format(len(results), num_crashes, len(groups)))
+        for i, g in enumerate(groups) :
+            f.write('## {}. {} ({}x)\n\n'.format(i + 1, g['signature'], len(g['runs'])))
+            f.write('Signature id: `{}`\n\n'.format(g['id']))
+            for entry in g['runs'] :
+                f.write('- {} / {}: `{}`\n'.format(entry['config'], entry['target'], entry['log']))
+            f.write('\n```\n{}\n```\n\n'.format('\n'.join(g['backtrace']).strip()))
+        others = [res for res in results if res['status'] not in ['ok', 'crash']]
+        if others :
+            f.write('## Other failures\n\n')
+            for res in others :
+                f.write('- {} / {}: {}\n'.format(res['config'], res['target'], res['status']))
+    return report_dir + '/crashes.md'
+
+#-------------------------------------------------------------------------------
+def batch(fips_dir, proj_dir, cfg_name, targets, target_args, num_jobs, timeout) :
+    """run targets non-interactively under gdb and group their crashes"""
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    util.ensure_valid_project_dir(proj_dir)
+    gdb_bin = settings.get(proj_dir, 'gdb') or 'gdb'
+
+    jobs = []
+    for cfg_name, cfg_targets in batchutil.get_batch_targets(fips_dir, proj_dir, cfg_name, targets) :
+        deploy_dir = util.get_deploy_dir(fips_dir, proj_name, cfg_name)
+        log_dir = get_log_dir(fips_dir, proj_name, cfg_name)
+        if not os.path.isdir(log_dir) :
+            os.makedirs(log_dir)
+        for target in cfg_targets :
+            jobs.append((gdb_bin, deploy_dir, log_dir, cfg_name, target, target_args, timeout))
+    if not jobs :
+        log.error('no targets to run')
+
+    log.colored(log.YELLOW, '=== gdb: {} run(s) on {} job(s)'.format(len(jobs), num_jobs))
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers = num_jobs) as executor :
+        for res in executor.map(run_session, jobs) :
+            text = '  {}: {} ({})'.format(res['config'], res['target'], res['status'])
+            if res['status'] == 'ok' :
+                log.info(text)
+            else :
+                log.colored(log.RED, text)
+            results.append(res)
+
+    groups = group_crashes(results)
+    report_path = write_report(get_report_dir(fips_dir, proj_dir), results, groups)
+    for g in groups :
+        log.colored(log.RED, '{:>4}x {}'.format(len(g['runs']), g['signature']))
+    log.info('report: {}'.format(report_path))
+    failed = [res for res in results if res['status'] != 'ok']
+    if failed :
+        log.error('{} of {} run(s) failed, {} unique crash(es)'.format(len(failed), len(results), len(groups)))
+    log.colored(log.GREEN, 'no crashes')
+    return True
+
 #-------------------------------------------------------------------------------
 def run(fips_dir, proj_dir, args) :
     """debug a single target with gdb"""
@@ -52,6 +270,10 @@ def run(fips_dir, proj_dir, args) :
         idx = args.index('--')
         target_args = args[(idx + 1):]
         args = args[:idx]
+    if '--batch' in args :
+        cfg_name, targets, opts = batchutil.parse_batch_args(proj_dir, args, { '--timeout': 300 })
+        batch(fips_dir, proj_dir, cfg_name, targets, target_args, int(opts['--jobs']), float(opts['--timeout']))
+        return
     if len(args) > 0 :
         tgt_name = args[0]
     if len(args) > 1:
@@ -71,4 +293,10 @@ def help() :
             "fips gdb [-- args]\n"
             "fips gdb [target] [-- args]\n"
             "fips gdb [target] [config] [-- args]\n" + log.DEF +
-            "    debug a single target in current or named config")
+            "    debug a single target in current or named config\n" + log.YELLOW +
+            "fips gdb --batch [target ...|all] [--config=cfg] [--jobs=N]\n"
+            "         [--timeout=sec] [-- args]\n" + log.DEF +
+            "    run several targets (or all app targets) of one or more configs\n"
+            "    under 'gdb -batch' in parallel, capture backtraces, registers and\n"
+            "    thread stacks of crashes, and group crashes with the same signal\n"
+            "    and top frames into fips-deploy/[proj]-crashes/crashes.md|json")
@@ -0,0 +1,141 @@
+"""implement 'genstats' verb (ranks the slowest code generator steps)
+
+genstats
+genstats [config]
+genstats clear [config]
+"""
+
+import os
+import json
+
+from mod import log, util, config, settings
+
+# must match fipsutil.ReportName in the generators directory
+ReportName = 'fipsutil-report.jsonl'
+
+#-------------------------------------------------------------------------------
+def find_reports(build_dir) :
+    """find all generator profile reports under a build directory"""
+    reports = []
+    for root, dirs, files in os.walk(build_dir) :
+        if ReportName in files :
+            reports.append(os.path.join(root, ReportName))
+    return sorted(reports)
+
+#-------------------------------------------------------------------------------
+def load_records(reports) :
+    """load the JSON records from report files, skipping broken lines"""
+    records = []
+    for report in reports :
+        with open(report, 'r') as f :
+            for line in f :
+                try :
+                    records.append(json.loads(line))
+                except ValueError :
+                    # a build interrupted while writing may leave a partial line
+                    pass
+    return records
+
+#-------------------------------------------------------------------------------
+def summarize(records) :
+    """aggregate records by generator and input file, slowest first"""
+    stats = {}
+    for rec in records :
+        key = (rec['generator'], rec['input'])
+        if key not in stats :
+            stats[key] = {
+                'generator': rec['generator'],
+                'input': rec['input'],
+                'runs': 0,
+                'time': 0.0,
+                'max': 0.0,
+                'phases': {},
+                'files': 0,
+                'bytes': 0
+            }
+        s = stats[key]
+        s['runs'] += 1
+        s['time'] += rec['time']
+        s['max'] = max(s['max'], rec['time'])
+        s['files'] += rec.get('files', 0)
+        s['bytes'] += rec.get('bytes', 0)
+        for name, seconds in rec.get('phases', {}).items() :
+            s['phases'][name] = s['phases'].get(name, 0.0) + seconds
+    return sorted(stats.values(), key=lambda s: s['time'], reverse=True)
+
+#-------------------------------------------------------------------------------
+def fmt_bytes(num_bytes) :
+    for unit in ['B', 'KB', 'MB'] :
+        if num_bytes < 1024 :
+            return '{:.0f} {}'.format(num_bytes, unit)
+        num_bytes /= 1024.0
+    return '{:.1f} GB'.format(num_bytes)
+
+#-------------------------------------------------------------------------------
+def print_stats(stats, proj_dir) :
+    total = sum(s['time'] for s in stats)
+    log.colored(log.YELLOW, '{:>9} {:>6} {:>9} {:>9} {:>7} {:>9}  {}'.format(
+        'total ms', 'runs', 'mean ms', 'max ms', 'files', 'bytes', 'generator: input'))
+    for s in stats :
+        inp = s['input']
+        if inp.startswith(proj_dir + os.sep) :
+            inp = os.path.relpath(inp, proj_dir)
+        log.info('{:>9.1f} {:>6} {:>9.1f} {:>9.1f} {:>7} {:>9}  {}: {}'.format(
+            s['time'] * 1000.0, s['runs'], s['time'] * 1000.0 / s['runs'], s['max'] * 1000.0,
+            s['files'], fmt_bytes(s['bytes']), s['generator'], inp))
+        if s['phases'] :
+            phases = sorted(s['phases'].items(), key=lambda p: p[1], reverse=True)
+            log.info('{:>9} {}'.format('', ', '.join('{}: {:.1f} ms'.format(name, seconds * 1000.0) for name, seconds in phases)))
+    log.colored(log.YELLOW, '{:>9.1f} ms in {} generator runs'.format(total * 1000.0, sum(s['runs'] for s in stats)))
+
+#-------------------------------------------------------------------------------
+def genstats(fips_dir, proj_dir, cfg_name, clear) :
+    """print or clear the generator profile reports of a config"""
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    util.ensure_valid_project_dir(proj_dir)
+
+    configs = config.load(fips_dir, proj_dir, cfg_name)
+    if not configs :
+        log.error("No valid configs found for '{}'".format(cfg_name))
+    for cfg in configs :
+        build_dir = util.get_build_dir(fips_dir, proj_name, cfg['name'])
+        log.colored(log.YELLOW, "=== genstats: {}".format(cfg['name']))
+        reports = find_reports(build_dir) if os.path.isdir(build_dir) else []
+        if clear :
+            for report in reports :
+                os.remove(report)
+            log.info('removed {} report file(s)'.format(len(reports)))
+            continue
+        stats = summarize(load_records(reports))
+        if stats :
+            print_stats(stats, proj_dir)
+        else :
+            log.info("no generator reports found in '{}'".format(build_dir))
+            log.info("build with FIPSUTIL_PROFILE=1 set to record them")
+    return True
+
+#-------------------------------------------------------------------------------
+def run(fips_dir, proj_dir, args) :
+    """print the slowest code generator steps"""
+    if not util.is_valid_project_dir(proj_dir) :
+        log.error('must be run in a project directory')
+    clear = False
+    if len(args) > 0 and args[0] == 'clear' :
+        clear = True
+        args = args[1:]
+    cfg_name = None
+    if len(args) > 0 :
+        cfg_name = args[0]
+    if not cfg_name :
+        cfg_name = settings.get(proj_dir, 'config')
+    genstats(fips_dir, proj_dir, cfg_name, clear)
+
+#-------------------------------------------------------------------------------
+def help() :
+    """print 'genstats' help"""
+    log.info(log.YELLOW +
+            "fips genstats\n"
+            "fips genstats [config]\n"
+            "fips genstats clear [config]\n" + log.DEF +
+            "    rank the slowest code generator steps of a build, recorded\n"
+            "    by building with the environment variable FIPSUTIL_PROFILE=1")
@@ -1,76 +1,315 @@
-import os, fnmatch, shutil, subprocess, re
+import os, fnmatch, shutil, subprocess, re, io, json, hashlib, mmap, multiprocessing
+import time, threading, functools, http.server, importlib.util
 from mod import log, util
 
-def build(fips_dir, proj_dir):
+# bump when the manifest layout or the generated HTML changes
+ManifestVersion = 1
+ManifestName = '.markdeep-manifest.json'
+
+# directories and files skipped when scanning for headers, extended
+# by the 'markdeep: exclude:' list in the project's fips.yml, patterns
+# are matched against the name and the project-relative path
+DefaultExcludes = [ '.*', 'fips-build', 'fips-deploy', 'node_modules', 'third_party', 'vendor' ]
+
+# below this number of changed headers, scan them in-process
+MinParallelHeaders = 64
+
+# poll interval of 'markdeep watch' in seconds
+WatchInterval = 0.1
+
+HtmlHeader = ("<meta charset='utf-8' emacsmode='-*- markdown -*-'>\n"
+              "<link rel='stylesheet' href='https://casual-effects.com/markdeep/latest/apidoc.css?'>\n")
+HtmlFooter = ("<script>markdeepOptions={tocStyle:'medium'};</script>"
+              "<!-- Markdeep: --><script src='https://casual-effects.com/markdeep/latest/markdeep.min.js?'></script>")
+
+def get_out_dir(fips_dir, proj_dir):
     # target directory will be 'fips-deploy/[proj]-markdeep
     proj_name = util.get_project_name_from_dir(proj_dir)
-    out_dir = util.get_workspace_dir(fips_dir)+'/fips-deploy/'+proj_name+'-markdeep'
-    log.info('building to: {}...'.format(out_dir))
-    if os.path.isdir(out_dir):
-        shutil.rmtree(out_dir)
-    os.makedirs(out_dir)
+    return util.get_workspace_dir(fips_dir)+'/fips-deploy/'+proj_name+'-markdeep'
+
+# extract the lines of all /*# #*/ blocks from a header's lines
+def extract_markdeep(lines):
+    capture_begin = re.compile(r'/\*#\s')
+    capturing = False
+    markdeep_lines = []
+    for line in lines:
+        if "#*/" in line and capturing:
+            capturing = False
+        if capturing:
+            # remove trailing tab
+            if line.startswith('    '):
+                line = line[4:]
+            elif line.startswith('\t'):
+                line = line[1:]
+            markdeep_lines.append(line)
+        if capture_begin.match(line) and not capturing:
+            capturing = True
+    return markdeep_lines
+
+# read a header, returns its content hash and extracted markdeep lines,
+# headers without a '/*#' are never decoded and split into lines
+def scan_header(hdr):
+    with open(hdr, 'rb') as src:
+        if os.fstat(src.fileno()).st_size == 0:
+            return hashlib.sha1(b'').hexdigest(), []
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            content_hash = hashlib.sha1(data).hexdigest()
+            if data.find(b'/*#') == -1:
+                return content_hash, []
+            # decode exactly like open(hdr, 'r') would
+            lines = io.TextIOWrapper(io.BytesIO(data[:])).readlines()
+    return content_hash, extract_markdeep(lines)
+
+# fork_map() is shared with the generators, verbs can't import it by
+# name, so it's loaded from the generators directory by file path
+def load_forkutil():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'generators', 'forkutil.py')
+    spec = importlib.util.spec_from_file_location('forkutil', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+forkutil = load_forkutil()
 
-    # check all .h files for embedded documentation
+# scan a list of headers, on forked worker processes if there are many
+def scan_headers(hdrs):
+    if len(hdrs) < MinParallelHeaders:
+        return [scan_header(hdr) for hdr in hdrs]
+    try:
+        return forkutil.fork_map(scan_header, hdrs, multiprocessing.cpu_count())
+    except forkutil.WorkerError as err:
+        log.error('scanning headers failed:\n{}'.format(err))
+
+def get_excludes(proj_dir):
+    excludes = list(DefaultExcludes)
+    fips_yml = util.load_fips_yml(proj_dir)
+    if fips_yml and isinstance(fips_yml.get('markdeep'), dict):
+        excludes.extend(fips_yml['markdeep'].get('exclude', []))
+    return excludes
+
+def is_excluded(name, rel_path, excludes):
+    for pattern in excludes:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern):
+            return True
+    return False
+
+# find all .h files in a project, skipping excluded directories,
+# returns (path, project-relative path) pairs, the visited directories
+# are appended to the optional dirs list
+def find_headers(proj_dir, excludes, dirs=None):
     hdrs = []
     for root, dirnames, filenames in os.walk(proj_dir):
+        if dirs is not None:
+            dirs.append(root)
+        rel_root = os.path.relpath(root, proj_dir)
+        if rel_root == '.':
+            rel_root = ''
+        match_root = rel_root.replace('\\','/') + '/' if rel_root else ''
+        dirnames[:] = [d for d in dirnames if not is_excluded(d, match_root + d, excludes)]
         for filename in fnmatch.filter(filenames, '*.h'):
-            hdrs.append(os.path.join(root, filename).replace('\\','/'))
-    markdeep_files = []
-    capture_begin = re.compile(r'/\*#\s')
-    for hdr in hdrs:
-        log.info('  parsing {}'.format(hdr))
-        capturing = False
-        markdeep_lines = []
-        with open(hdr, 'r') as src:
-            lines = src.readlines()
-            for line in lines:
-                if "#*/" in line and capturing:
-                    capturing = False
-                if capturing:
-                    # remove trailing tab
-                    if line.startswith('    '):
-                        line = line[4:]
-                    elif line.startswith('\t'):
-                        line = line[1:]
-                    markdeep_lines.append(line)
-                if capture_begin.match(line) and not capturing:
-                    capturing = True
-        if markdeep_lines:
-            markdeep_files.append(hdr)
-            dst_path = out_dir + '/' + os.path.relpath(hdr,proj_dir) + '.html'
-            log.info('    markdeep block(s) found, writing: {}'.format(dst_path))
-            dst_dir = os.path.dirname(dst_path)
-            if not os.path.isdir(dst_dir):
-                os.makedirs(dst_dir)
-            with open(dst_path, 'w') as dst:
-                dst.write("<meta charset='utf-8' emacsmode='-*- markdown -*-'>\n")
-                dst.write("<link rel='stylesheet' href='https://casual-effects.com/markdeep/latest/apidoc.css?'>\n")
-                for line in markdeep_lines:
-                    dst.write(line)
-                dst.write("<script>markdeepOptions={tocStyle:'medium'};</script>")
-                dst.write("<!-- Markdeep: --><script src='https://casual-effects.com/markdeep/latest/markdeep.min.js?'></script>")
-    
-    # write a toplevel index.html
-    if markdeep_files:
-        markdeep_files = sorted(markdeep_files)
-        dst_path = out_dir + '/index.html'
+            if not is_excluded(filename, match_root + filename, excludes):
+                hdrs.append((os.path.join(root, filename).replace('\\','/'), os.path.join(rel_root, filename)))
+    return hdrs
+
+def page_html(markdeep_lines):
+    return HtmlHeader + ''.join(markdeep_lines) + HtmlFooter
+
+def index_html(proj_name, rel_paths):
+    html = HtmlHeader + '# {}\n'.format(proj_name)
+    for rel_path in rel_paths:
+        html += '- [{}]({})\n'.format(rel_path, rel_path+'.html')
+    return html + HtmlFooter
+
+def get_page_path(out_dir, rel_path):
+    return out_dir + '/' + rel_path + '.html'
+
+# write a file only if its content changed, returns True if written
+def write_if_changed(path, text):
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            if f.read() == text:
+                return False
+    dst_dir = os.path.dirname(path)
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    with open(path, 'w') as dst:
+        dst.write(text)
+    return True
+
+# remove a generated page and its then empty parent directories
+def remove_page(out_dir, rel_path):
+    path = get_page_path(out_dir, rel_path)
+    if os.path.isfile(path):
+        log.info('  removing {}'.format(path))
+        os.remove(path)
+    dst_dir = os.path.dirname(path)
+    while dst_dir != out_dir and os.path.isdir(dst_dir) and not os.listdir(dst_dir):
+        os.rmdir(dst_dir)
+        dst_dir = os.path.dirname(dst_dir)
+
+def load_manifest(out_dir):
+    try:
+        with open(out_dir + '/' + ManifestName, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == ManifestVersion:
+            return manifest
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def save_manifest(out_dir, manifest):
+    with open(out_dir + '/' + ManifestName, 'w') as f:
+        f.write(json.dumps(manifest, sort_keys=True))
+
+# check if a header's manifest entry and page are still valid
+def is_entry_valid(out_dir, rel_path, entry):
+    # a page deleted from the output directory must be rebuilt
+    return entry and (not entry['documented'] or os.path.isfile(get_page_path(out_dir, rel_path)))
+
+def is_unchanged(entry, st):
+    return entry['mtime'] == st.st_mtime and entry['size'] == st.st_size
+
+# update the page of a scanned header, returns the header's new manifest entry
+def update_header(out_dir, hdr, rel_path, st, entry, content_hash, markdeep_lines):
+    dst_path = get_page_path(out_dir, rel_path)
+    new_entry = { 'mtime': st.st_mtime, 'size': st.st_size, 'hash': content_hash, 'documented': bool(markdeep_lines) }
+    if is_entry_valid(out_dir, rel_path, entry) and entry['hash'] == content_hash:
+        # touched but not modified
+        return new_entry
+    log.info('  parsing {}'.format(hdr))
+    if markdeep_lines:
+        if write_if_changed(dst_path, page_html(markdeep_lines)):
+            log.info('    markdeep block(s) changed, writing: {}'.format(dst_path))
+    elif entry and entry['documented']:
+        remove_page(out_dir, rel_path)
+    return new_entry
+
+# write the toplevel index.html if the set of documented headers changed
+def update_index(out_dir, proj_name, manifest):
+    rel_paths = sorted(rel_path for rel_path, entry in manifest['headers'].items() if entry['documented'])
+    dst_path = out_dir + '/index.html'
+    if rel_paths and (rel_paths != manifest['index'] or not os.path.isfile(dst_path)):
         log.info('writing toc file: {}'.format(dst_path))
-        with open(dst_path, 'w') as dst:
-            dst.write("<meta charset='utf-8' emacsmode='-*- markdown -*-'>\n")
-            dst.write("<link rel='stylesheet' href='https://casual-effects.com/markdeep/latest/apidoc.css?'>\n")
-            dst.write('# {}\n'.format(proj_name))
-            for hdr in markdeep_files:
-                rel_path = os.path.relpath(hdr,proj_dir)
-                dst.write('- [{}]({})\n'.format(rel_path, rel_path+'.html'))
-            dst.write("<script>markdeepOptions={tocStyle:'medium'};</script>")
-            dst.write("<!-- Markdeep: --><script src='https://casual-effects.com/markdeep/latest/markdeep.min.js?'></script>")
-    else:
+        write_if_changed(dst_path, index_html(proj_name, rel_paths))
+    elif not rel_paths and os.path.isfile(dst_path):
+        os.remove(dst_path)
+    manifest['index'] = rel_paths
+    return rel_paths
+
+# check a list of headers for embedded documentation and update their
+# pages, only headers changed since the last update are scanned,
+# returns True if any header was scanned or removed
+def update_headers(out_dir, manifest, hdrs):
+    old_headers = manifest['headers']
+    headers = {}
+    changed = []
+    for hdr, rel_path in hdrs:
+        entry = old_headers.get(rel_path)
+        try:
+            st = os.stat(hdr)
+        except OSError:
+            # deleted since the directory was scanned
+            continue
+        if is_entry_valid(out_dir, rel_path, entry) and is_unchanged(entry, st):
+            headers[rel_path] = entry
+        else:
+            changed.append((hdr, rel_path, st))
+    results = scan_headers([hdr for hdr, _, _ in changed])
+    for (hdr, rel_path, st), (content_hash, markdeep_lines) in zip(changed, results):
+        headers[rel_path] = update_header(out_dir, hdr, rel_path, st, old_headers.get(rel_path), content_hash, markdeep_lines)
+
+    # remove the pages of deleted headers
+    removed = False
+    for rel_path, entry in old_headers.items():
+        if rel_path not in headers:
+            removed = True
+            if entry['documented']:
+                remove_page(out_dir, rel_path)
+    manifest['headers'] = headers
+    return removed or len(changed) > 0
+
+def build(fips_dir, proj_dir):
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    out_dir = get_out_dir(fips_dir, proj_dir)
+    log.info('building to: {}...'.format(out_dir))
+    manifest = load_manifest(out_dir)
+    if not manifest:
+        # no usable manifest, start from scratch
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        manifest = { 'version': ManifestVersion, 'headers': {}, 'index': [] }
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    hdrs = find_headers(proj_dir, get_excludes(proj_dir))
+    update_headers(out_dir, manifest, hdrs)
+    rel_paths = update_index(out_dir, proj_name, manifest)
+    save_manifest(out_dir, manifest)
+    if not rel_paths:
         log.error("no headers with embedded markdeep found in '{}'!".format(proj_dir))
+    return manifest
+
+# returns the mtimes of the scanned directories, a changed directory
+# mtime means that files were added, removed or renamed in it
+def get_dir_mtimes(dirs):
+    mtimes = {}
+    for path in dirs:
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+# serve the output directory on a background thread
+def serve(out_dir, port):
+    handler = functools.partial(QuietHandler, directory=out_dir)
+    try:
+        server = http.server.ThreadingHTTPServer(('localhost', port), handler)
+    except OSError as err:
+        log.error('failed to start http server on port {}: {}'.format(port, err))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log.info('serving {} at http://localhost:{}/index.html'.format(out_dir, port))
+
+# keep the documentation up to date while headers are edited, polls
+# the mtimes of the known headers and directories, and only rebuilds
+# the pages of changed headers (and the index if needed)
+def watch(fips_dir, proj_dir, port):
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    out_dir = get_out_dir(fips_dir, proj_dir)
+    manifest = build(fips_dir, proj_dir)
+    excludes = get_excludes(proj_dir)
+    dirs = []
+    hdrs = find_headers(proj_dir, excludes, dirs)
+    dir_mtimes = get_dir_mtimes(dirs)
+    if port:
+        serve(out_dir, port)
+    log.colored(log.YELLOW, 'watching {} headers in {}, press Ctrl-C to stop...'.format(len(hdrs), proj_dir))
+    try:
+        while True:
+            time.sleep(WatchInterval)
+            start_time = time.time()
+            if get_dir_mtimes(dirs) != dir_mtimes:
+                dirs = []
+                hdrs = find_headers(proj_dir, excludes, dirs)
+                dir_mtimes = get_dir_mtimes(dirs)
+            if update_headers(out_dir, manifest, hdrs):
+                update_index(out_dir, proj_name, manifest)
+                log.info('  updated in {:.1f} ms'.format((time.time() - start_time) * 1000.0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # a stale manifest only causes changed headers to be rescanned
+        # by the next build, so it's only written when watching stops
+        save_manifest(out_dir, manifest)
 
 # view generated markdeep in browser, we don't need a local http server for that
 def view(fips_dir, proj_dir):
-    proj_name = util.get_project_name_from_dir(proj_dir)
-    out_dir = util.get_workspace_dir(fips_dir)+'/fips-deploy/'+proj_name+'-markdeep'
+    out_dir = get_out_dir(fips_dir, proj_dir)
     if os.path.isfile(out_dir+'/index.html'):
         p = util.get_host_platform()
         if p == 'osx':
@@ -84,6 +323,10 @@ def view(fips_dir, proj_dir):
 
 # the verb's standard "run" function
 def run(fips_dir, proj_dir, args):
+    port = None
+    for arg in [arg for arg in args if arg.startswith('--serve')]:
+        args.remove(arg)
+        port = int(arg.split('=')[1]) if '=' in arg else 8000
     if len(args) > 0:
         if len(args) > 1:
             proj_name = args[1]
@@ -96,17 +339,26 @@ def run(fips_dir, proj_dir, args):
             # view also build the markdown docs first
             build(fips_dir, proj_dir)
             view(fips_dir, proj_dir)
+        elif args[0] == 'watch':
+            watch(fips_dir, proj_dir, port)
         else:
-            log.error("expected 'build' or 'view' arg")
+            log.error("expected 'build', 'view' or 'watch' arg")
     else:
-        log.error("expected 'build' or 'view' arg")
+        log.error("expected 'build', 'view' or 'watch' arg")
 
 # the verb's standard "help" function
 def help():
     log.info(log.YELLOW +
         "fips markdeep build [proj]\n"
-        "fips markdeep view [proj]\n"+log.DEF+
-        "    Generate or view Markdeep documentation webpage.\n"
+        "fips markdeep view [proj]\n"
+        "fips markdeep watch [proj] [--serve[=port]]\n"+log.DEF+
+        "    Generate or view Markdeep documentation webpage, or keep it\n"
+        "    up to date while headers are edited (optionally serving it\n"
+        "    at http://localhost:8000).\n"
         "    Parses all *.h files in a project, searches for special\n"
         "    /*# #*/ comment blocks, and extracts them into Markdeep\n"
-        "    HTML files.")
+        "    HTML files. Hidden directories, fips-build, fips-deploy,\n"
+        "    node_modules, third_party and vendor are skipped, more\n"
+        "    patterns can be added to the project's fips.yml:\n"
+        "        markdeep:\n"
+        "            exclude: [ 'ext/*', 'tests' ]")
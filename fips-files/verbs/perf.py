@@ -0,0 +1,294 @@
+"""implement 'perf' verb (profiles a single target with Linux perf)
+
+perf
+perf [target]
+perf [target] [config] [--stat] [--freq=N] [--top=N] [-- args]
+perf --script=file [--top=N]
+"""
+
+import os
+import re
+import time
+import zlib
+import subprocess
+
+from mod import log, util, config, settings
+
+# header line of a sample in 'perf script' output: 'comm pid[/tid] ...'
+SampleHeader = re.compile(r'^(\S.*?)\s+(\d+)(/\d+)?\s')
+# a stack frame line: 'addr symbol+offset (dso)'
+StackFrame = re.compile(r'^\s+[0-9a-fA-F]+\s+(.*?)\s+\((.*)\)\s*$')
+SymbolOffset = re.compile(r'\+0x[0-9a-fA-F]+$')
+
+# flamegraph layout
+SvgWidth = 1200
+FrameHeight = 16
+FontSize = 12
+CharWidth = 7
+
+#-------------------------------------------------------------------------------
+def get_perf_bin(proj_dir) :
+    perf_bin = settings.get(proj_dir, 'perf')
+    if not perf_bin :
+        perf_bin = 'perf'
+    return perf_bin
+
+#-------------------------------------------------------------------------------
+def get_output_dir(fips_dir, proj_name, cfg_name) :
+    """per-config directory for perf data and reports"""
+    return util.get_build_dir(fips_dir, proj_name, cfg_name) + '/perf'
+
+#-------------------------------------------------------------------------------
+def clean_symbol(sym, dso) :
+    """strip the offset from a symbol, unknown symbols are named after their dso"""
+    if sym.startswith('[unknown]') :
+        return '[{}]'.format(os.path.basename(dso)) if dso and dso != '[unknown]' else '[unknown]'
+    return SymbolOffset.sub('', sym)
+
+#-------------------------------------------------------------------------------
+def fold_stacks(lines) :
+    """turn 'perf script' output into folded stacks ('comm;root;...;leaf' => samples)"""
+    folded = {}
+    comm = None
+    frames = []
+    for line in lines :
+        if not line.strip() :
+            if comm is not None :
+                # frames are listed leaf first
+                key = ';'.join([comm] + frames[::-1])
+                folded[key] = folded.get(key, 0) + 1
+            comm = None
+            frames = []
+        elif line[0].isspace() :
+            m = StackFrame.match(line)
+            if m and comm is not None :
+                frames.append(clean_symbol(m.group(1), m.group(2)))
+        else :
+            m = SampleHeader.match(line)
+            comm = m.group(1).replace(';', ':') if m else None
+    if comm is not None :
+        key = ';'.join([comm] + frames[::-1])
+        folded[key] = folded.get(key, 0) + 1
+    return folded
+
+#-------------------------------------------------------------------------------
+def write_folded(path, folded) :
+    with open(path, 'w') as f :
+        for stack, count in sorted(folded.items()) :
+            f.write('{} {}\n'.format(stack, count))
+
+#-------------------------------------------------------------------------------
+def build_tree(folded) :
+    """merge folded stacks into a tree of { 'name', 'value', 'children' } nodes"""
+    root = { 'name': 'all', 'value': 0, 'children': {} }
+    for stack, count in folded.items() :
+        root['value'] += count
+        node = root
+        for name in stack.split(';') :
+            if name not in node['children'] :
+                node['children'][name] = { 'name': name, 'value': 0, 'children': {} }
+            node = node['children'][name]
+            node['value'] += count
+    return root
+
+#-------------------------------------------------------------------------------
+def xml_escape(text) :
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+#-------------------------------------------------------------------------------
+def frame_color(name) :
+    """a stable warm color per function name"""
+    h = zlib.crc32(name.encode('utf-8'))
+    return 'rgb({},{},{})'.format(205 + h % 50, 80 + (h >> 8) % 130, (h >> 16) % 55)
+
+#-------------------------------------------------------------------------------
+def get_depth(node) :
+    if not node['children'] :
+        return 1
+    return 1 + max(get_depth(child) for child in node['children'].values())
+
+#-------------------------------------------------------------------------------
+def write_flamegraph(path, folded, title) :
+    """write folded stacks as a self-contained flamegraph SVG, frame
+    tooltips show the function name, sample count and percentage"""
+    root = build_tree(folded)
+    total = max(1, root['value'])
+    depth = get_depth(root)
+    top_margin = 2 * FrameHeight
+    height = top_margin + depth * FrameHeight + FrameHeight
+    scale = float(SvgWidth - 20) / total
+    rects = []
+    # iterative depth-first layout, children sorted by name like flamegraph.pl
+    todo = [(root, 10.0, 0)]
+    while todo :
+        node, x, level = todo.pop()
+        width = node['value'] * scale
+        if width < 0.1 :
+            continue
+        y = height - FrameHeight - (level + 1) * FrameHeight
+        info = '{} ({:,} samples, {:.2f}%)'.format(node['name'], node['value'], node['value'] * 100.0 / total)
+        label = ''
+        max_chars = int((width - 6) / CharWidth)
+        if max_chars >= 3 :
+            label = node['name'] if len(node['name']) <= max_chars else node['name'][:max_chars - 2] + '..'
+        rects.append('<g><title>{}</title><rect x="{:.1f}" y="{}" width="{:.1f}" height="{}" fill="{}" rx="2"/>'
+            '<text x="{:.1f}" y="{}">{}</text></g>'.format(xml_escape(info), x, y, width, FrameHeight - 1,
+            frame_color(node['name']), x + 3, y + FrameHeight - 4, xml_escape(label)))
+        child_x = x
+        for name in sorted(node['children']) :
+            child = node['children'][name]
+            todo.append((child, child_x, level + 1))
+            child_x += child['value'] * scale
+    with open(path, 'w') as f :
+        f.write('<?xml version="1.0" standalone="no"?>\n')
+        f.write('<svg version="1.1" width="{}" height="{}" xmlns="http://www.w3.org/2000/svg">\n'.format(SvgWidth, height))
+        f.write('<style>text {{ font-family: Verdana, sans-serif; font-size: {}px; fill: #000; }} '
+            'rect:hover {{ stroke: #000; stroke-width: 0.5; }}</style>\n'.format(FontSize))
+        f.write('<rect width="100%" height="100%" fill="#f8f8f8"/>\n')
+        f.write('<text x="{}" y="{}" text-anchor="middle" style="font-size: {}px">{}</text>\n'.format(
+            SvgWidth // 2, FrameHeight + 4, FontSize + 4, xml_escape(title)))
+        f.write('\n'.join(rects))
+        f.write('\n</svg>\n')
+
+#-------------------------------------------------------------------------------
+def print_top_symbols(folded, top) :
+    """print the functions with the most samples, by self time (leaf frame)
+    and total time (anywhere on the stack, counted once per stack)"""
+    total = sum(folded.values())
+    if not total :
+        log.info('no samples')
+        return
+    self_samples = {}
+    total_samples = {}
+    for stack, count in folded.items() :
+        frames = stack.split(';')[1:]
+        if not frames :
+            continue
+        self_samples[frames[-1]] = self_samples.get(frames[-1], 0) + count
+        for name in set(frames) :
+            total_samples[name] = total_samples.get(name, 0) + count
+    log.colored(log.YELLOW, '{:>10} {:>8} {:>10} {:>8}  {}'.format('self', '%', 'total', '%', 'symbol'))
+    for name, count in sorted(self_samples.items(), key=lambda item: item[1], reverse=True)[:top] :
+        log.info('{:>10,} {:>7.2f}% {:>10,} {:>7.2f}%  {}'.format(count, count * 100.0 / total,
+            total_samples[name], total_samples[name] * 100.0 / total, name))
+    log.info('{:,} samples'.format(total))
+
+#-------------------------------------------------------------------------------
+def report(script_path, top, title) :
+    """post-process 'perf script' output into folded stacks, a flamegraph
+    SVG and a top symbols table, the outputs are written next to the input"""
+    prefix = os.path.splitext(script_path)[0]
+    try :
+        with open(script_path, 'r', errors='replace') as f :
+            folded = fold_stacks(f)
+    except (IOError, OSError) as err :
+        log.error("failed to read '{}': {}".format(script_path, err))
+    write_folded(prefix + '.folded', folded)
+    write_flamegraph(prefix + '.svg', folded, title)
+    print_top_symbols(folded, top)
+    log.info('folded stacks: {}.folded'.format(prefix))
+    log.info('flamegraph: {}.svg'.format(prefix))
+
+#-------------------------------------------------------------------------------
+def perf(fips_dir, proj_dir, cfg_name, target, target_args, opts) :
+    """profile a single target with perf"""
+
+    # prepare
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    util.ensure_valid_project_dir(proj_dir)
+    perf_bin = get_perf_bin(proj_dir)
+
+    # load the config(s)
+    configs = config.load(fips_dir, proj_dir, cfg_name)
+    if configs :
+        for cfg in configs :
+            # check if config is valid
+            config_valid, _ = config.check_config_valid(fips_dir, proj_dir, cfg, print_errors = True)
+            if config_valid :
+                deploy_dir = util.get_deploy_dir(fips_dir, proj_name, cfg['name'])
+                out_dir = get_output_dir(fips_dir, proj_name, cfg['name'])
+                if not os.path.isdir(out_dir) :
+                    os.makedirs(out_dir)
+                prefix = '{}/{}.{}'.format(out_dir, target, time.strftime('%Y%m%d-%H%M%S'))
+                target_cmd = [ './{}'.format(target) ] + target_args
+                try :
+                    if opts['stat'] :
+                        log.colored(log.YELLOW, "=== perf stat: {}".format(cfg['name']))
+                        subprocess.call([perf_bin, 'stat', '-o', prefix + '.stat', '--'] + target_cmd, cwd = deploy_dir)
+                        with open(prefix + '.stat', 'r') as f :
+                            log.info(f.read())
+                        continue
+                    log.colored(log.YELLOW, "=== perf record: {}".format(cfg['name']))
+                    res = subprocess.call([perf_bin, 'record', '-F', str(opts['freq']), '-g',
+                        '-o', prefix + '.data', '--'] + target_cmd, cwd = deploy_dir)
+                    if res != 0 or not os.path.isfile(prefix + '.data') :
+                        log.error("perf record failed (check /proc/sys/kernel/perf_event_paranoid)")
+                    with open(prefix + '.script', 'w') as f :
+                        subprocess.check_call([perf_bin, 'script', '-i', prefix + '.data'], cwd = deploy_dir, stdout = f)
+                except OSError :
+                    log.error("Failed to execute perf (not installed?)")
+                except subprocess.CalledProcessError :
+                    log.error("perf script failed")
+                report(prefix + '.script', opts['top'], '{} ({})'.format(target, cfg['name']))
+            else :
+                log.error("Config '{}' not valid in this environment".format(cfg['name']))
+    else :
+        log.error("No valid configs found for '{}'".format(cfg_name))
+
+    return True
+
+#-------------------------------------------------------------------------------
+def run(fips_dir, proj_dir, args) :
+    """profile a single target with perf"""
+    tgt_name = None
+    cfg_name = None
+    target_args = []
+    if '--' in args :
+        idx = args.index('--')
+        target_args = args[(idx + 1):]
+        args = args[:idx]
+    opts = { 'stat': False, 'freq': 999, 'top': 20, 'script': None }
+    positional = []
+    for arg in args :
+        if arg == '--stat' :
+            opts['stat'] = True
+        elif arg.startswith('--') :
+            key, _, value = arg[2:].partition('=')
+            if key not in ['freq', 'top', 'script'] or not value :
+                log.error("invalid option '{}'".format(arg))
+            opts[key] = value if key == 'script' else int(value)
+        else :
+            positional.append(arg)
+    if opts['script'] :
+        # post-process a previously recorded 'perf script' output
+        report(opts['script'], opts['top'], os.path.basename(opts['script']))
+        return
+    if not util.is_valid_project_dir(proj_dir) :
+        log.error('must be run in a project directory')
+    if len(positional) > 0 :
+        tgt_name = positional[0]
+    if len(positional) > 1 :
+        cfg_name = positional[1]
+    if not cfg_name :
+        cfg_name = settings.get(proj_dir, 'config')
+    if not tgt_name :
+        tgt_name = settings.get(proj_dir, 'target')
+    if not tgt_name :
+        log.error('no target specified')
+    perf(fips_dir, proj_dir, cfg_name, tgt_name, target_args, opts)
+
+#-------------------------------------------------------------------------------
+def help() :
+    """print 'perf' help"""
+    log.info(log.YELLOW +
+            "fips perf [-- args]\n"
+            "fips perf [target] [-- args]\n"
+            "fips perf [target] [config] [--freq=N] [--top=N] [-- args]\n" + log.DEF +
+            "    profile a single target in current or named config with 'perf record'\n"
+            "    (sampling at --freq Hz, default 999) and write folded stacks, a\n"
+            "    flamegraph SVG and a table of the top symbols to the config's build\n"
+            "    directory under perf/\n" + log.YELLOW +
+            "fips perf [target] [config] --stat [-- args]\n" + log.DEF +
+            "    run a single target under 'perf stat'\n" + log.YELLOW +
+            "fips perf --script=file [--top=N]\n" + log.DEF +
+            "    post-process a saved 'perf script' output file")
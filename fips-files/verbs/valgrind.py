@@ -3,12 +3,65 @@
 valgrind
 valgrind [target]
 valgrind [target] [config]
+valgrind --tool=callgrind|massif|cachegrind [target] [config]
+valgrind --report [file ...]
+valgrind --diff [old] [new]
+valgrind --batch [target ...|all] [--config=cfg] [--jobs=N]
+         [--baseline=file] [--save-baseline=file] [-- valgrind args]
 """
 
+import os
+import re
+import glob
+import time
+import json
+import shlex
 import subprocess
+import importlib.util
+import concurrent.futures
 
 from mod import log, util, config, project, settings
 
+#-------------------------------------------------------------------------------
+def load_batchutil() :
+    # shared with the 'gdb' verb, loaded by file path since every
+    # module in the verbs directory is loaded as a verb
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'generators', 'batchutil.py')
+    spec = importlib.util.spec_from_file_location('batchutil', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+batchutil = load_batchutil()
+
+# memcheck options of batch runs, a leak check is needed for the summary
+BatchArgs = [ '--leak-check=full', '--track-fds=yes', '--run-libc-freeres=no' ]
+
+# the memcheck summary values which are checked for regressions
+SummaryKeys = [ 'errors', 'definitely_lost', 'indirectly_lost', 'possibly_lost' ]
+
+ErrorSummary = re.compile(r'ERROR SUMMARY: ([\d,]+) errors? from')
+LeakSummary = re.compile(r'(definitely|indirectly|possibly) lost: ([\d,]+) bytes in')
+# valgrind options of the profiling tools, {out} is the output file
+ToolPresets = {
+    'callgrind': [ '--tool=callgrind', '--callgrind-out-file={out}' ],
+    'cachegrind': [ '--tool=cachegrind', '--cache-sim=yes', '--cachegrind-out-file={out}' ],
+    'massif': [ '--tool=massif', '--massif-out-file={out}' ]
+}
+
+Terminated = re.compile(r'Process terminating with default action of signal (\d+)')
+
+#-------------------------------------------------------------------------------
+def get_valgrind_bin(proj_dir) :
+    valgrind_bin = settings.get(proj_dir, 'valgrind')
+    if not valgrind_bin :
+        valgrind_bin = 'valgrind'
+    return valgrind_bin
+
+#-------------------------------------------------------------------------------
+def get_log_dir(fips_dir, proj_name, cfg_name) :
+    """per-config directory for valgrind logs and outputs"""
+    return util.get_build_dir(fips_dir, proj_name, cfg_name) + '/valgrind'
+
 #-------------------------------------------------------------------------------
 def valgrind(fips_dir, proj_dir, cfg_name, target, target_args) :
     """debug a single target with valgrind"""
@@ -25,19 +78,22 @@ def valgrind(fips_dir, proj_dir, cfg_name, target, target_args) :
             config_valid, _ = config.check_config_valid(fips_dir, proj_dir, cfg, print_errors = True)
             if config_valid :
                 deploy_dir = util.get_deploy_dir(fips_dir, proj_name, cfg['name'])
-                valgrind_bin = settings.get(proj_dir, 'valgrind')
-                if not valgrind_bin :
-                    valgrind_bin = 'valgrind'
+                valgrind_bin = get_valgrind_bin(proj_dir)
                 log.colored(log.YELLOW, "=== valgrind: {} ({})".format(cfg['name'], valgrind_bin))
                 cmd_line = valgrind_bin
                 if target_args :
                     cmd_line += ' ' + ' '.join(target_args)
                 else :
+                    # one log file per config, so that configs don't overwrite each other
+                    log_dir = get_log_dir(fips_dir, proj_name, cfg['name'])
+                    if not os.path.isdir(log_dir) :
+                        os.makedirs(log_dir)
                     cmd_line += ' ' + '--leak-check=no'
                     cmd_line += ' ' + '--show-reachable=yes'
                     cmd_line += ' ' + '--track-fds=yes'
                     cmd_line += ' ' + '--run-libc-freeres=no'
-                    cmd_line += ' ' + "--log-file={}/valgrind-{}.log".format(proj_dir, target)
+                    cmd_line += ' ' + "--log-file={}/{}.memcheck.log".format(log_dir, target)
+                    log.info("log file: {}/{}.memcheck.log".format(log_dir, target))
                 cmd_line += ' ' + "./{}".format(target)
                 #log.colored(log.GREEN, "cmdline: {}".format(cmd_line))
                 subprocess.call(args = cmd_line, cwd = deploy_dir, shell = True)
@@ -48,6 +104,452 @@ def valgrind(fips_dir, proj_dir, cfg_name, target, target_args) :
 
     return True
 
+#-------------------------------------------------------------------------------
+def parse_memcheck_log(path) :
+    """parse the error count and leaked bytes from a memcheck log, values
+    are None if the log has no summary (e.g. valgrind didn't run)"""
+    summary = { key: None for key in SummaryKeys }
+    summary['signal'] = None
+    try :
+        with open(path, 'r', errors='replace') as f :
+            for line in f :
+                m = ErrorSummary.search(line)
+                if m :
+                    summary['errors'] = int(m.group(1).replace(',', ''))
+                    continue
+                m = LeakSummary.search(line)
+                if m :
+                    summary[m.group(1) + '_lost'] = int(m.group(2).replace(',', ''))
+                    continue
+                m = Terminated.search(line)
+                if m :
+                    summary['signal'] = int(m.group(1))
+    except (IOError, OSError) :
+        return summary
+    if summary['errors'] is not None :
+        # no leak summary means that all heap blocks were freed
+        for key in SummaryKeys :
+            if summary[key] is None :
+                summary[key] = 0
+    return summary
+
+#-------------------------------------------------------------------------------
+def run_memcheck(job) :
+    """run one target of one config through memcheck, returns the result"""
+    valgrind_bin, valgrind_args, deploy_dir, log_dir, cfg_name, target = job
+    result = {
+        'config': cfg_name,
+        'target': target,
+        'log': '{}/{}.memcheck.log'.format(log_dir, target),
+        'returncode': None
+    }
+    result.update({ key: None for key in SummaryKeys })
+    if not os.path.isfile(os.path.join(deploy_dir, target)) :
+        result['status'] = 'missing'
+        return result
+    cmd = shlex.split(valgrind_bin) + BatchArgs + valgrind_args
+    cmd += [ '--log-file={}'.format(result['log']), './{}'.format(target) ]
+    # the target's own output goes next to the log instead of the terminal
+    with open('{}/{}.out'.format(log_dir, target), 'w') as out :
+        try :
+            result['returncode'] = subprocess.call(cmd, cwd=deploy_dir, stdout=out, stderr=subprocess.STDOUT)
+        except OSError as err :
+            result['status'] = 'failed to execute valgrind: {}'.format(err)
+            return result
+    result.update(parse_memcheck_log(result['log']))
+    if result['errors'] is None :
+        result['status'] = 'no summary'
+    elif result['signal'] or result['returncode'] < 0 :
+        result['status'] = 'signal {}'.format(result['signal'] or -result['returncode'])
+    else :
+        result['status'] = 'ok'
+    return result
+
+#-------------------------------------------------------------------------------
+def find_regressions(results, baseline) :
+    """returns (result, reason) pairs of runs which are worse than the
+    baseline, without a baseline any error, leak or crash is a regression"""
+    regressions = []
+    for res in results :
+        if res['status'] != 'ok' :
+            regressions.append((res, res['status']))
+            continue
+        base = baseline.get('{}/{}'.format(res['config'], res['target'])) if baseline else None
+        for key in SummaryKeys :
+            base_value = base.get(key, 0) if base else 0
+            if res[key] > base_value :
+                regressions.append((res, '{} {} > {}'.format(key.replace('_', ' '), res[key], base_value)))
+    return regressions
+
+#-------------------------------------------------------------------------------
+def fmt_value(value) :
+    return '-' if value is None else str(value)
+
+#-------------------------------------------------------------------------------
+def print_summary(results) :
+    fmt = '{:<24} {:<24} {:>8} {:>12} {:>12} {:>12}  {}'
+    log.colored(log.YELLOW, fmt.format('config', 'target', 'errors', 'definite', 'indirect', 'possible', 'status'))
+    for res in results :
+        line = fmt.format(res['config'], res['target'], fmt_value(res['errors']),
+            fmt_value(res['definitely_lost']), fmt_value(res['indirectly_lost']),
+            fmt_value(res['possibly_lost']), res['status'])
+        if res['status'] == 'ok' and not any(res[key] for key in SummaryKeys) :
+            log.info(line)
+        else :
+            log.colored(log.RED, line)
+
+#-------------------------------------------------------------------------------
+def batch(fips_dir, proj_dir, cfg_name, targets, valgrind_args, num_jobs, baseline_path, save_baseline_path) :
+    """run the config x target matrix through memcheck on a bounded pool"""
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    util.ensure_valid_project_dir(proj_dir)
+    valgrind_bin = get_valgrind_bin(proj_dir)
+
+    jobs = []
+    for cfg_name, cfg_targets in batchutil.get_batch_targets(fips_dir, proj_dir, cfg_name, targets) :
+        deploy_dir = util.get_deploy_dir(fips_dir, proj_name, cfg_name)
+        log_dir = get_log_dir(fips_dir, proj_name, cfg_name)
+        if not os.path.isdir(log_dir) :
+            os.makedirs(log_dir)
+        for target in cfg_targets :
+            jobs.append((valgrind_bin, valgrind_args, deploy_dir, log_dir, cfg_name, target))
+    if not jobs :
+        log.error('no targets to run')
+
+    # each run is a separate valgrind process, the pool threads only wait for them
+    log.colored(log.YELLOW, '=== valgrind: {} run(s) on {} job(s)'.format(len(jobs), num_jobs))
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_jobs) as executor :
+        for res in executor.map(run_memcheck, jobs) :
+            log.info('  {}: {} ({})'.format(res['config'], res['target'], res['status']))
+            results.append(res)
+    print_summary(results)
+
+    baseline = None
+    if baseline_path :
+        try :
+            with open(baseline_path, 'r') as f :
+                baseline = json.load(f)
+        except (IOError, OSError, ValueError) as err :
+            log.error("failed to load baseline '{}': {}".format(baseline_path, err))
+    if save_baseline_path :
+        with open(save_baseline_path, 'w') as f :
+            json.dump({ '{}/{}'.format(res['config'], res['target']): { key: res[key] for key in SummaryKeys }
+                for res in results if res['status'] == 'ok' }, f, indent=2, sort_keys=True)
+        log.info("baseline written to '{}'".format(save_baseline_path))
+
+    regressions = find_regressions(results, baseline)
+    if regressions :
+        for res, reason in regressions :
+            log.colored(log.RED, '{}: {}: {}'.format(res['config'], res['target'], reason))
+        log.error('{} valgrind regression(s) found'.format(len(regressions)))
+    log.colored(log.GREEN, 'no valgrind regressions')
+    return True
+
+#-------------------------------------------------------------------------------
+def get_output_dir(fips_dir, proj_name, cfg_name, tool) :
+    """per-config directory for the outputs of a profiling tool"""
+    return get_log_dir(fips_dir, proj_name, cfg_name) + '/' + tool
+
+#-------------------------------------------------------------------------------
+def find_outputs(out_dir, target) :
+    """returns the profiling outputs of a target, oldest first"""
+    return sorted(glob.glob('{}/{}.*.out'.format(out_dir, target)))
+
+#-------------------------------------------------------------------------------
+def resolve_name(names, kind, value) :
+    """resolve callgrind's compressed '(id) name' and '(id)' strings"""
+    if not value.startswith('(') :
+        return value
+    idx, _, name = value[1:].partition(')')
+    name = name.strip()
+    if name :
+        names[(kind, idx)] = name
+        return name
+    return names.get((kind, idx), value)
+
+#-------------------------------------------------------------------------------
+def add_costs(dst, costs) :
+    for i, cost in enumerate(costs[:len(dst)]) :
+        dst[i] += cost
+
+#-------------------------------------------------------------------------------
+def parse_callgrind(path) :
+    """parse a callgrind or cachegrind output file into the total costs and
+    the exclusive and inclusive costs per function (recursive calls are
+    not added to the function's inclusive cost)"""
+    events = []
+    num_positions = 1
+    totals = None
+    names = {}
+    functions = {}
+    fn = None
+    callee = None
+    in_call = False
+    with open(path, 'r', errors='replace') as f :
+        for line in f :
+            c = line[:1]
+            if c.isdigit() or c in '+-*' :
+                # a cost line: positions followed by costs, missing costs are 0
+                costs = [int(item) for item in line.split()[num_positions:]]
+                if fn is None :
+                    continue
+                if in_call :
+                    # the inclusive cost of a call
+                    if callee != fn :
+                        add_costs(functions[fn]['incl'], costs)
+                    in_call = False
+                else :
+                    add_costs(functions[fn]['excl'], costs)
+                    add_costs(functions[fn]['incl'], costs)
+            elif line.startswith('events:') :
+                events = line.split()[1:]
+            elif line.startswith('positions:') :
+                num_positions = len(line.split()) - 1
+            elif line.startswith('summary:') or line.startswith('totals:') :
+                totals = [int(item) for item in line.split()[1:]]
+            else :
+                key, _, value = line.rstrip('\n').partition('=')
+                if key == 'fn' :
+                    fn = resolve_name(names, 'fn', value)
+                    if fn not in functions :
+                        functions[fn] = { 'excl': [0] * len(events), 'incl': [0] * len(events) }
+                elif key == 'cfn' :
+                    callee = resolve_name(names, 'fn', value)
+                elif key == 'calls' :
+                    in_call = True
+                elif key in ['fl', 'fi', 'fe', 'cfi', 'cfl'] :
+                    resolve_name(names, 'fl', value)
+                elif key in ['ob', 'cob'] :
+                    resolve_name(names, 'ob', value)
+    if totals is None :
+        totals = [0] * len(events)
+        for costs in functions.values() :
+            add_costs(totals, costs['excl'])
+    totals += [0] * (len(events) - len(totals))
+    return { 'type': 'callgrind', 'events': events, 'totals': totals, 'functions': functions }
+
+#-------------------------------------------------------------------------------
+def parse_massif(path) :
+    """parse a massif output file into its snapshots, each with the
+    top-level allocation sites of detailed snapshots"""
+    snapshots = []
+    time_unit = 'i'
+    snapshot = None
+    with open(path, 'r', errors='replace') as f :
+        for line in f :
+            key, _, value = line.rstrip('\n').partition('=')
+            if line.startswith('time_unit:') :
+                time_unit = line.split(':', 1)[1].strip()
+            elif key == 'snapshot' :
+                snapshot = { 'time': 0, 'heap': 0, 'extra': 0, 'stacks': 0, 'tree': 'empty', 'sites': [] }
+                snapshots.append(snapshot)
+            elif snapshot is None :
+                continue
+            elif key == 'time' :
+                snapshot['time'] = int(value)
+            elif key == 'mem_heap_B' :
+                snapshot['heap'] = int(value)
+            elif key == 'mem_heap_extra_B' :
+                snapshot['extra'] = int(value)
+            elif key == 'mem_stacks_B' :
+                snapshot['stacks'] = int(value)
+            elif key == 'heap_tree' :
+                snapshot['tree'] = value
+            elif line.startswith(' n') and not line.startswith('  ') :
+                # a direct child of the heap tree's root: 'n<children>: <bytes> <site>'
+                _, _, rest = line.strip().partition(': ')
+                num_bytes, _, site = rest.partition(' ')
+                # strip the code address from '0x4005F4: main (prog.c:10)'
+                if site.startswith('0x') and ': ' in site :
+                    site = site.split(': ', 1)[1]
+                snapshot['sites'].append((site, int(num_bytes)))
+    peak = None
+    for snapshot in snapshots :
+        if snapshot['tree'] == 'peak' :
+            peak = snapshot
+    if peak is None and snapshots :
+        peak = max(snapshots, key=lambda s: s['heap'] + s['extra'])
+    return { 'type': 'massif', 'time_unit': time_unit, 'snapshots': snapshots, 'peak': peak }
+
+#-------------------------------------------------------------------------------
+def parse_output(path) :
+    """parse a callgrind, cachegrind or massif output file"""
+    try :
+        with open(path, 'r', errors='replace') as f :
+            for line in f :
+                if line.startswith('snapshot=') :
+                    return parse_massif(path)
+                if line.startswith('events:') :
+                    return parse_callgrind(path)
+    except (IOError, OSError) as err :
+        log.error("failed to read '{}': {}".format(path, err))
+    log.error("'{}' is not a callgrind, cachegrind or massif output file".format(path))
+
+#-------------------------------------------------------------------------------
+def get_event_index(data, event) :
+    if not event :
+        return 0
+    if event not in data['events'] :
+        log.error("unknown event '{}', expected one of: {}".format(event, ', '.join(data['events'])))
+    return data['events'].index(event)
+
+#-------------------------------------------------------------------------------
+def fmt_percent(value, total) :
+    return '{:.2f}%'.format(value * 100.0 / total) if total else '-'
+
+#-------------------------------------------------------------------------------
+def fmt_change(old, new) :
+    if old :
+        return '{:+.2f}%'.format((new - old) * 100.0 / old)
+    return '-' if not new else 'new'
+
+#-------------------------------------------------------------------------------
+def report_callgrind(data, top, event) :
+    idx = get_event_index(data, event)
+    total = data['totals'][idx]
+    log.info('totals: ' + ', '.join('{} {:,}'.format(ev, cost) for ev, cost in zip(data['events'], data['totals'])))
+    for kind in ['incl', 'excl'] :
+        log.colored(log.YELLOW, '{:>16} {:>8}  {} ({})'.format(data['events'][idx], '%',
+            'function', 'inclusive' if kind == 'incl' else 'exclusive'))
+        funcs = sorted(data['functions'].items(), key=lambda item: item[1][kind][idx], reverse=True)
+        for name, costs in funcs[:top] :
+            log.info('{:>16,} {:>8}  {}'.format(costs[kind][idx], fmt_percent(costs[kind][idx], total), name))
+
+#-------------------------------------------------------------------------------
+def fmt_bytes(num_bytes) :
+    for unit in ['B', 'KB', 'MB'] :
+        if abs(num_bytes) < 1024 :
+            return '{:.1f} {}'.format(num_bytes, unit) if unit != 'B' else '{} B'.format(num_bytes)
+        num_bytes /= 1024.0
+    return '{:.1f} GB'.format(num_bytes)
+
+#-------------------------------------------------------------------------------
+def report_massif(data, top, num_rows=20) :
+    peak = data['peak']
+    if not peak :
+        log.info('no snapshots')
+        return
+    log.info('peak: {} heap + {} extra = {} at time {}{} ({} stacks)'.format(
+        fmt_bytes(peak['heap']), fmt_bytes(peak['extra']), fmt_bytes(peak['heap'] + peak['extra']),
+        peak['time'], data['time_unit'], fmt_bytes(peak['stacks'])))
+    log.colored(log.YELLOW, '{:>12} {:>8}  {}'.format('bytes', '%', 'allocation site at peak'))
+    for site, num_bytes in sorted(peak['sites'], key=lambda s: s[1], reverse=True)[:top] :
+        log.info('{:>12,} {:>8}  {}'.format(num_bytes, fmt_percent(num_bytes, peak['heap']), site))
+
+    # an evenly sampled timeline of the heap size, always including the peak
+    snapshots = data['snapshots']
+    step = max(1, len(snapshots) // num_rows)
+    rows = [s for i, s in enumerate(snapshots) if i % step == 0 or s is peak]
+    max_bytes = max(1, peak['heap'] + peak['extra'])
+    log.colored(log.YELLOW, '{:>16} {:>12}  {}'.format('time ({})'.format(data['time_unit']), 'heap', 'timeline'))
+    for s in rows :
+        num_bytes = s['heap'] + s['extra']
+        log.info('{:>16,} {:>12}  {}{}'.format(s['time'], fmt_bytes(num_bytes),
+            '#' * int(50 * num_bytes / max_bytes), ' <- peak' if s is peak else ''))
+
+#-------------------------------------------------------------------------------
+def report(path, top, event) :
+    """print the hotspots or heap profile of a valgrind output file"""
+    data = parse_output(path)
+    log.colored(log.YELLOW, '=== {}: {}'.format(data['type'], path))
+    if data['type'] == 'massif' :
+        report_massif(data, top)
+    else :
+        report_callgrind(data, top, event)
+
+#-------------------------------------------------------------------------------
+def diff(old_path, new_path, top, event, threshold) :
+    """compare two valgrind output files of the same tool, fails if the
+    total cost or peak heap grew by more than threshold percent"""
+    old = parse_output(old_path)
+    new = parse_output(new_path)
+    if old['type'] != new['type'] :
+        log.error("can't compare {} and {} output".format(old['type'], new['type']))
+    log.colored(log.YELLOW, '=== {} diff: {} => {}'.format(new['type'], old_path, new_path))
+    if new['type'] == 'massif' :
+        old_peak = (old['peak']['heap'] + old['peak']['extra']) if old['peak'] else 0
+        new_peak = (new['peak']['heap'] + new['peak']['extra']) if new['peak'] else 0
+        log.info('peak heap: {} => {} ({})'.format(fmt_bytes(old_peak), fmt_bytes(new_peak), fmt_change(old_peak, new_peak)))
+        old_sites = dict(old['peak']['sites']) if old['peak'] else {}
+        new_sites = dict(new['peak']['sites']) if new['peak'] else {}
+        changes = [(site, old_sites.get(site, 0), new_sites.get(site, 0)) for site in set(old_sites) | set(new_sites)]
+        label = 'allocation site at peak'
+        old_total, new_total = old_peak, new_peak
+    else :
+        idx = get_event_index(new, event)
+        if old['events'] != new['events'] :
+            log.error('the two runs recorded different events')
+        for ev, old_cost, new_cost in zip(new['events'], old['totals'], new['totals']) :
+            log.info('{}: {:,} => {:,} ({})'.format(ev, old_cost, new_cost, fmt_change(old_cost, new_cost)))
+        names = set(old['functions']) | set(new['functions'])
+        empty = { 'excl': [0] * len(new['events']) }
+        changes = [(name, old['functions'].get(name, empty)['excl'][idx], new['functions'].get(name, empty)['excl'][idx]) for name in names]
+        label = 'function ({} exclusive)'.format(new['events'][idx])
+        old_total, new_total = old['totals'][idx], new['totals'][idx]
+
+    changes = sorted([c for c in changes if c[1] != c[2]], key=lambda c: abs(c[2] - c[1]), reverse=True)
+    log.colored(log.YELLOW, '{:>16} {:>16} {:>16} {:>9}  {}'.format('old', 'new', 'change', '%', label))
+    for name, old_value, new_value in changes[:top] :
+        line = '{:>16,} {:>16,} {:>+16,} {:>9}  {}'.format(old_value, new_value, new_value - old_value, fmt_change(old_value, new_value), name)
+        if new_value > old_value :
+            log.colored(log.RED, line)
+        else :
+            log.colored(log.GREEN, line)
+
+    if threshold is not None and old_total and (new_total - old_total) * 100.0 / old_total > threshold :
+        log.error('regression: {} grew by {} (threshold {}%)'.format(
+            'peak heap' if new['type'] == 'massif' else new['events'][idx], fmt_change(old_total, new_total), threshold))
+    return True
+
+#-------------------------------------------------------------------------------
+def profile(fips_dir, proj_dir, cfg_name, target, tool, valgrind_args, top, event) :
+    """run a single target with a valgrind profiling tool and print a report"""
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    util.ensure_valid_project_dir(proj_dir)
+    valgrind_bin = get_valgrind_bin(proj_dir)
+
+    configs = config.load(fips_dir, proj_dir, cfg_name)
+    if not configs :
+        log.error("No valid configs found for '{}'".format(cfg_name))
+    for cfg in configs :
+        config_valid, _ = config.check_config_valid(fips_dir, proj_dir, cfg, print_errors = True)
+        if not config_valid :
+            log.error("Config '{}' not valid in this environment".format(cfg['name']))
+        deploy_dir = util.get_deploy_dir(fips_dir, proj_name, cfg['name'])
+        out_dir = get_output_dir(fips_dir, proj_name, cfg['name'], tool)
+        if not os.path.isdir(out_dir) :
+            os.makedirs(out_dir)
+        # timestamped, so that earlier runs are kept for diffing
+        out_path = '{}/{}.{}.out'.format(out_dir, target, time.strftime('%Y%m%d-%H%M%S'))
+        cmd = shlex.split(valgrind_bin) + [arg.format(out=out_path) for arg in ToolPresets[tool]]
+        cmd += valgrind_args + [ './{}'.format(target) ]
+        log.colored(log.YELLOW, "=== valgrind {}: {} ({})".format(tool, cfg['name'], valgrind_bin))
+        try :
+            subprocess.call(cmd, cwd = deploy_dir)
+        except OSError :
+            log.error("Failed to execute valgrind (not installed?)")
+        if os.path.isfile(out_path) :
+            log.info('output: {}'.format(out_path))
+            report(out_path, top, event)
+        else :
+            log.warn("no {} output written for '{}'".format(tool, target))
+    return True
+
+#-------------------------------------------------------------------------------
+def diff_latest(fips_dir, proj_dir, cfg_name, target, tool, top, event, threshold) :
+    """compare the two most recent profiling runs of a target"""
+    proj_name = util.get_project_name_from_dir(proj_dir)
+    configs = config.load(fips_dir, proj_dir, cfg_name)
+    if not configs :
+        log.error("No valid configs found for '{}'".format(cfg_name))
+    for cfg in configs :
+        outputs = find_outputs(get_output_dir(fips_dir, proj_name, cfg['name'], tool), target)
+        if len(outputs) < 2 :
+            log.error("need two {} runs of '{}' in config '{}' to compare".format(tool, target, cfg['name']))
+        diff(outputs[-2], outputs[-1], top, event, threshold)
+    return True
+
 #-------------------------------------------------------------------------------
 def run(fips_dir, proj_dir, args) :
     """debug a single target with valgrind"""
@@ -60,6 +562,37 @@ def run(fips_dir, proj_dir, args) :
         idx = args.index('--')
         tgt_args = args[(idx + 1):]
         args = args[:idx]
+    if '--batch' in args :
+        cfg_name, targets, opts = batchutil.parse_batch_args(proj_dir, args, { '--baseline': None, '--save-baseline': None })
+        batch(fips_dir, proj_dir, cfg_name, targets, tgt_args, int(opts['--jobs']),
+            opts['--baseline'], opts['--save-baseline'])
+        return
+    opts = { '--tool': 'memcheck', '--top': '20', '--event': None, '--threshold': None }
+    mode = None
+    positional = []
+    for arg in args :
+        key, _, value = arg.partition('=')
+        if key in opts and value :
+            opts[key] = value
+        elif arg in ['--report', '--diff'] :
+            mode = arg
+        else :
+            positional.append(arg)
+    args = positional
+    tool = opts['--tool']
+    top = int(opts['--top'])
+    threshold = float(opts['--threshold']) if opts['--threshold'] else None
+    if tool != 'memcheck' and tool not in ToolPresets :
+        log.error("unknown tool '{}', expected one of: memcheck, {}".format(tool, ', '.join(sorted(ToolPresets))))
+    if mode == '--report' :
+        if not args :
+            log.error('no valgrind output file specified')
+        for path in args :
+            report(path, top, opts['--event'])
+        return
+    if mode == '--diff' and len(args) == 2 and os.path.isfile(args[0]) and os.path.isfile(args[1]) :
+        diff(args[0], args[1], top, opts['--event'], threshold)
+        return
     if len(args) > 0 :
         tgt_name = args[0]
     if len(args) > 1 :
@@ -70,7 +603,14 @@ def run(fips_dir, proj_dir, args) :
         tgt_name = settings.get(proj_dir, 'target')
     if not tgt_name :
         log.error('no target specified')
-    valgrind(fips_dir, proj_dir, cfg_name, tgt_name, tgt_args)
+    if mode == '--diff' :
+        if tool not in ToolPresets :
+            log.error('--diff of the latest runs needs a --tool')
+        diff_latest(fips_dir, proj_dir, cfg_name, tgt_name, tool, top, opts['--event'], threshold)
+    elif tool in ToolPresets :
+        profile(fips_dir, proj_dir, cfg_name, tgt_name, tool, tgt_args, top, opts['--event'])
+    else :
+        valgrind(fips_dir, proj_dir, cfg_name, tgt_name, tgt_args)
 
 #-------------------------------------------------------------------------------
 def help() :
@@ -79,4 +619,26 @@ def help() :
             "fips valgrind\n"
             "fips valgrind [target]\n"
             "fips valgrind [target] [config]\n" + log.DEF +
-            "    debug a single target in current or named config")
+            "    debug a single target in current or named config\n" + log.YELLOW +
+            "fips valgrind --tool=callgrind|massif|cachegrind [target] [config]\n"
+            "              [--top=N] [--event=name] [-- args]\n" + log.DEF +
+            "    profile a single target, the output is written to the config's\n"
+            "    build directory under valgrind/[tool]/ and summarized as a table\n"
+            "    of the top-N functions by inclusive and exclusive cost (callgrind,\n"
+            "    cachegrind) or the peak heap, its allocation sites and a timeline\n"
+            "    (massif)\n" + log.YELLOW +
+            "fips valgrind --report [file ...]\n" + log.DEF +
+            "    summarize existing callgrind, cachegrind or massif output files\n" + log.YELLOW +
+            "fips valgrind --diff [old] [new] [--threshold=percent]\n"
+            "fips valgrind --diff --tool=[tool] [target] [config] [--threshold=percent]\n" + log.DEF +
+            "    compare two output files (or the two latest runs of a target),\n"
+            "    and fail if the total cost or peak heap grew by more than the\n"
+            "    threshold\n" + log.YELLOW +
+            "fips valgrind --batch [target ...|all] [--config=cfg] [--jobs=N]\n"
+            "              [--baseline=file] [--save-baseline=file] [-- args]\n" + log.DEF +
+            "    run several targets (or all app targets) of one or more configs\n"
+            "    (config names may contain wildcards) through memcheck in parallel,\n"
+            "    print a summary of errors and leaked bytes per run and fail if\n"
+            "    a run is worse than the baseline (or has any errors or leaks if\n"
+            "    no baseline is given); logs are written to the config's build\n"
+            "    directory under valgrind/")
@@ -0,0 +1,94 @@
+'''
+    Test setup: generators and verbs are loaded by file path without
+    registering them in sys.modules, like fips does.
+
+    genutil and fips' 'mod' package are taken from a fips checkout in
+    the workspace (or $FIPS_DIR), if there's none, minimal stand-ins
+    are used.
+'''
+
+import os
+import sys
+import types
+import importlib.util
+import pytest
+
+RootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GeneratorsDir = os.path.join(RootDir, 'fips-files', 'generators')
+VerbsDir = os.path.join(RootDir, 'fips-files', 'verbs')
+FixturesDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+#-------------------------------------------------------------------------------
+def find_fips_dir() :
+    fips_dir = os.environ.get('FIPS_DIR') or os.path.join(os.path.dirname(RootDir), 'fips')
+    if os.path.isfile(os.path.join(fips_dir, 'generators', 'genutil.py')) :
+        return fips_dir
+    return None
+
+#-------------------------------------------------------------------------------
+def install_stand_ins() :
+    genutil = types.ModuleType('genutil')
+    genutil.Env = {}
+    def fmtError(msg, terminate=True) :
+        sys.stderr.write('error: {}\n'.format(msg))
+        if terminate :
+            sys.exit(10)
+    genutil.fmtError = fmtError
+    genutil.setErrorLocation = lambda path, line : None
+    genutil.getEnv = lambda key, default=None : genutil.Env.get(key, default)
+
+    mod = types.ModuleType('mod')
+    log = types.ModuleType('mod.log')
+    log.YELLOW = log.RED = log.GREEN = log.BLUE = log.DEF = ''
+    log.info = lambda msg : print(msg)
+    log.colored = lambda color, msg : print(msg)
+    log.warn = lambda msg : print('warning: {}'.format(msg))
+    def error(msg, fatal=True) :
+        print('error: {}'.format(msg))
+        if fatal :
+            sys.exit(10)
+    log.error = error
+    mod.log = log
+    # only what the verbs reference at import time
+    for name in [ 'util', 'config', 'settings', 'project' ] :
+        sub = types.ModuleType('mod.' + name)
+        setattr(mod, name, sub)
+        sys.modules['mod.' + name] = sub
+    sys.modules.update({ 'genutil': genutil, 'mod': mod, 'mod.log': log })
+
+FipsDir = find_fips_dir()
+if FipsDir :
+    sys.path.insert(0, os.path.join(FipsDir, 'generators'))
+    sys.path.insert(0, FipsDir)
+else :
+    install_stand_ins()
+# for 'import fipsutil', appended so that the standard library wins
+sys.path.append(GeneratorsDir)
+
+#-------------------------------------------------------------------------------
+def load_module(name, path) :
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+#-------------------------------------------------------------------------------
+@pytest.fixture
+def load_generator() :
+    return lambda name : load_module(name, os.path.join(GeneratorsDir, name + '.py'))
+
+#-------------------------------------------------------------------------------
+@pytest.fixture
+def load_verb() :
+    return lambda name : load_module(name, os.path.join(VerbsDir, name + '.py'))
+
+#-------------------------------------------------------------------------------
+@pytest.fixture
+def fixtures_dir() :
+    return FixturesDir
+
+#-------------------------------------------------------------------------------
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch) :
+    # keep the YAML config cache of the generators out of the user's cache
+    monkeypatch.setenv('FIPSUTIL_CACHE_DIR', str(tmp_path / 'fipsutil-cache'))
@@ -0,0 +1,74 @@
+'''
+    Change detection of the copy generator.
+'''
+
+import os
+import shutil
+import pytest
+
+#-------------------------------------------------------------------------------
+@pytest.fixture
+def copy(load_generator) :
+    return load_generator('copy')
+
+#-------------------------------------------------------------------------------
+def test_same_second_edit(copy, tmp_path) :
+    src = str(tmp_path / 'src.txt')
+    dst = str(tmp_path / 'dst.txt')
+    with open(src, 'w') as f :
+        f.write('aaaa')
+    os.utime(src, ns=(1000000000, 1000000000))
+    shutil.copy2(src, dst)
+    assert copy.is_up_to_date(src, dst, os.stat(src), 'mtime')
+    # same size, same second, different content
+    with open(src, 'w') as f :
+        f.write('bbbb')
+    os.utime(src, ns=(1000000000, 1000500000))
+    assert not copy.is_up_to_date(src, dst, os.stat(src), 'mtime')
+
+#-------------------------------------------------------------------------------
+def test_racy_listing(copy, tmp_path) :
+    path = str(tmp_path / 'assets')
+    os.mkdir(path)
+    for name in [ 'a.txt', 'b.txt' ] :
+        with open(os.path.join(path, name), 'w') as f :
+            f.write(name)
+        os.utime(os.path.join(path, name), (1000, 1000))
+    stats = { 'entries': 0 }
+    listed = {}
+    assert not copy.scan_dir(path, {}, listed, 2000, stats)
+    # a file added in the same timestamp tick as the listing
+    dir_mtime_ns = os.stat(path).st_mtime_ns
+    with open(os.path.join(path, 'c.txt'), 'w') as f :
+        f.write('c')
+    os.utime(os.path.join(path, 'c.txt'), (1000, 1000))
+    os.utime(path, ns=(dir_mtime_ns, dir_mtime_ns))
+    assert copy.scan_dir(path, listed, {}, 2000, stats)
+
+    # listings of directories which are older than the margin are used
+    os.utime(path, (1000, 1000))
+    listed = {}
+    assert not copy.scan_dir(path, {}, listed, 2000, stats)
+    rescanned = {}
+    assert not copy.scan_dir(path, listed, rescanned, 2000, stats)
+    assert rescanned[path] is listed[path]
+
+#-------------------------------------------------------------------------------
+def test_unchanged_manifest(copy, tmp_path, monkeypatch) :
+    monkeypatch.setattr(copy.util, 'isDirty', lambda version, inputs, outputs : False, raising=False)
+    path = str(tmp_path / 'assets')
+    os.mkdir(path)
+    with open(os.path.join(path, 'a.txt'), 'w') as f :
+        f.write('a')
+    os.utime(os.path.join(path, 'a.txt'), (1000, 1000))
+    os.utime(path, (1000, 1000))
+    out_file = str(tmp_path / 'copy.h')
+    with open(out_file, 'w') as f :
+        f.write('')
+    manifest_path = str(tmp_path / 'copy.h.manifest.json')
+    config = { 'files': [ 'assets' ] }
+    dirty, manifest = copy.check_dirty(str(tmp_path), None, out_file, config, manifest_path)
+    assert not dirty and manifest
+    copy.save_manifest(manifest_path, manifest)
+    # nothing changed, nothing to save
+    assert copy.check_dirty(str(tmp_path), None, out_file, config, manifest_path) == (False, None)
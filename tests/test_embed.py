@@ -0,0 +1,168 @@
+'''
+    Compile the output of each embed format with the local gcc, and check
+    that the embedded bytes round-trip.
+'''
+
+import os
+import zlib
+import random
+import shutil
+import subprocess
+import pytest
+
+pytestmark = pytest.mark.skipif(not shutil.which('gcc'), reason='needs gcc')
+
+# prints the name, size and hex data of each embedded item
+MainSource = '''
+#include <stdio.h>
+#include <stdint.h>
+#include "data.h"
+int main(void) {
+    for (int i = 0; i < EMBED_NUM_ITEMS; i++) {
+        printf("%s %d ", embed_items[i].name, embed_items[i].size);
+        for (int j = 0; j < embed_items[i].size; j++) {
+            printf("%02x", embed_items[i].ptr[j]);
+        }
+        printf("\\n");
+    }
+    return 0;
+}
+'''
+
+#-------------------------------------------------------------------------------
+def make_files(src_dir) :
+    rnd = random.Random(4)
+    files = {
+        'random.bin': bytes(rnd.getrandbits(8) for _ in range(5000)),
+        'all_bytes.bin': bytes(range(256)) * 3,
+        # escapes followed by digits, quotes, backslashes and trigraphs
+        'tricky.txt': b'\x001234\x7f5"quote"\\back\\??=??/\n\t9\xff0',
+        'odd.bin': b'\x01\x02\x03',
+        'copy.bin': bytes(range(256)) * 3
+    }
+    for name, data in files.items() :
+        with open(os.path.join(src_dir, name), 'wb') as f :
+            f.write(data)
+    return files
+
+#-------------------------------------------------------------------------------
+def build_and_run(src_dir, sources) :
+    with open(os.path.join(src_dir, 'main.c'), 'w') as f :
+        f.write(MainSource)
+    exe = os.path.join(src_dir, 'main')
+    subprocess.check_call([ 'gcc', '-std=c99', '-Wall', '-Werror', '-o', exe, 'main.c' ] + sources, cwd=src_dir)
+    output = subprocess.check_output([ exe ]).decode('ascii')
+    items = {}
+    for line in output.splitlines() :
+        name, size, data = (line.split(' ') + [''])[:3]
+        items[name] = [ int(size), bytes.fromhex(data) ]
+    return items
+
+#-------------------------------------------------------------------------------
+def generate(embed, src_dir, options, out_src=None) :
+    with open(os.path.join(src_dir, 'data.yml'), 'w') as f :
+        f.write('options:\n    list_items: full\n    jobs: 2\n')
+        for key, value in options.items() :
+            f.write('    {}: {}\n'.format(key, value))
+        f.write('files:\n')
+        for name in sorted(os.listdir(src_dir)) :
+            if name.endswith(('.bin', '.txt')) :
+                f.write('    - {}\n'.format(name))
+    embed.generate(os.path.join(src_dir, 'data.yml'), out_src, os.path.join(src_dir, 'data.h'))
+
+#-------------------------------------------------------------------------------
+@pytest.mark.parametrize('format', [ 'array', 'string', 'incbin' ])
+@pytest.mark.parametrize('dedup', [ False, True ])
+def test_round_trip(load_generator, tmp_path, format, dedup) :
+    embed = load_generator('embed')
+    src_dir = str(tmp_path)
+    files = make_files(src_dir)
+    generate(embed, src_dir, { 'format': format, 'dedup': str(dedup).lower() }, os.path.join(src_dir, 'data.S'))
+    items = build_and_run(src_dir, [ 'data.S' ])
+    assert sorted(items) == sorted(files)
+    for name, data in files.items() :
+        assert items[name] == [ len(data), data ]
+
+#-------------------------------------------------------------------------------
+@pytest.mark.parametrize('format', [ 'array', 'string', 'incbin' ])
+def test_compressed_round_trip(load_generator, tmp_path, format) :
+    embed = load_generator('embed')
+    src_dir = str(tmp_path)
+    files = make_files(src_dir)
+    generate(embed, src_dir, { 'format': format, 'compress': 'zlib' }, os.path.join(src_dir, 'data.S'))
+    items = build_and_run(src_dir, [ 'data.S' ])
+    for name, data in files.items() :
+        size, stored = items[name]
+        assert size == len(stored)
+        # incompressible files are stored as is
+        assert stored == data or zlib.decompress(stored) == data
+
+#-------------------------------------------------------------------------------
+def test_incbin_requires_preprocessed_source(load_generator, tmp_path) :
+    embed = load_generator('embed')
+    src_dir = str(tmp_path)
+    make_files(src_dir)
+    with pytest.raises(SystemExit) :
+        generate(embed, src_dir, { 'format': 'incbin' }, os.path.join(src_dir, 'data.s'))
+    with pytest.raises(SystemExit) :
+        generate(embed, src_dir, { 'format': 'incbin' })
+
+#-------------------------------------------------------------------------------
+def test_shared_mixed_formats(load_generator, tmp_path) :
+    # the same file as 'array' in one header and 'string' in another
+    embed = load_generator('embed')
+    src_dir = str(tmp_path)
+    data = bytes(range(256)) * 3
+    for format in [ 'array', 'string' ] :
+        os.makedirs(os.path.join(src_dir, format))
+        with open(os.path.join(src_dir, format, 'data.bin'), 'wb') as f :
+            f.write(data)
+        with open(os.path.join(src_dir, format, 'data.yml'), 'w') as f :
+            f.write('options:\n    prefix: {}_\n    format: {}\n    shared: ../shared.h\nfiles:\n    - data.bin\n'.format(format, format))
+        embed.generate(os.path.join(src_dir, format, 'data.yml'), None, os.path.join(src_dir, format, 'data.h'))
+    with open(os.path.join(src_dir, 'main.c'), 'w') as f :
+        f.write('#include <stdio.h>\n#include <string.h>\n')
+        f.write('#include "array/data.h"\n#include "string/data.h"\n#include "shared.h"\n')
+        f.write('int main(void) {{ return memcmp(array_data_bin, string_data_bin, {}) != 0; }}\n'.format(len(data)))
+    exe = os.path.join(src_dir, 'main')
+    subprocess.check_call([ 'gcc', '-std=c99', '-Wall', '-Werror', '-o', exe, 'main.c' ], cwd=src_dir)
+    subprocess.check_call([ exe ])
+
+#-------------------------------------------------------------------------------
+def test_shared_concurrent_users(load_generator, tmp_path) :
+    # headers sharing one shared header, generated by parallel processes
+    embed = load_generator('embed')
+    src_dir = str(tmp_path)
+    num_users = 8
+    for i in range(num_users) :
+        os.makedirs(os.path.join(src_dir, str(i)))
+        with open(os.path.join(src_dir, str(i), 'data.bin'), 'wb') as f :
+            f.write(bytes([ i ]) * 1000)
+        with open(os.path.join(src_dir, str(i), 'data.yml'), 'w') as f :
+            f.write('options:\n    prefix: user{}_\n    shared: ../shared.h\nfiles:\n    - data.bin\n'.format(i))
+    pids = []
+    for i in range(num_users) :
+        pid = os.fork()
+        if pid == 0 :
+            try :
+                embed.generate(os.path.join(src_dir, str(i), 'data.yml'), None, os.path.join(src_dir, str(i), 'data.h'))
+            finally :
+                os._exit(0)
+        pids.append(pid)
+    for pid in pids :
+        os.waitpid(pid, 0)
+    with open(os.path.join(src_dir, 'shared.h'), 'r') as f :
+        assert f.read().count('unsigned char embed_blob_') == num_users
+    assert not [ name for name in os.listdir(os.path.join(src_dir, 'shared.h.embed')) if name.endswith('.tmp') ]
+
+#-------------------------------------------------------------------------------
+def test_compress_level_change(load_generator, tmp_path) :
+    embed = load_generator('embed')
+    src_dir = str(tmp_path)
+    data = b''.join('line {} of a compressible file\n'.format(i % 97).encode('ascii') for i in range(2000))
+    with open(os.path.join(src_dir, 'text.txt'), 'wb') as f :
+        f.write(data)
+    for level in [ 1, 9 ] :
+        generate(embed, src_dir, { 'compress': 'zlib', 'compress_level': level }, os.path.join(src_dir, 'data.S'))
+        items = build_and_run(src_dir, [ 'data.S' ])
+        assert items['text.txt'][1] == zlib.compress(data, level)
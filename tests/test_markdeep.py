@@ -0,0 +1,33 @@
+'''
+    Header scanning of the 'markdeep' verb, in-process and on forked
+    worker processes.
+'''
+
+import os
+import pytest
+
+#-------------------------------------------------------------------------------
+@pytest.fixture
+def markdeep(load_verb) :
+    return load_verb('markdeep')
+
+#-------------------------------------------------------------------------------
+def test_scan_headers(markdeep, tmp_path, monkeypatch) :
+    hdrs = []
+    for i in range(markdeep.MinParallelHeaders * 2) :
+        hdr = str(tmp_path / 'hdr{}.h'.format(i))
+        with open(hdr, 'w') as f :
+            if i % 3 :
+                f.write('/*# \n    header {}\n#*/\nvoid func{}(void);\n'.format(i, i))
+            else :
+                f.write('void func{}(void);\n'.format(i))
+        hdrs.append(hdr)
+    expected = [ markdeep.scan_header(hdr) for hdr in hdrs ]
+    assert expected[1][1] == [ 'header 1\n' ]
+    monkeypatch.setattr(markdeep.multiprocessing, 'cpu_count', lambda : 4)
+    assert markdeep.scan_headers(hdrs) == expected
+
+    # worker failures are reported with the worker's exception
+    os.remove(hdrs[-1])
+    with pytest.raises(SystemExit) :
+        markdeep.scan_headers(hdrs)
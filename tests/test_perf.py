@@ -0,0 +1,88 @@
+'''
+    Post-processing of the 'perf' verb, against a 'perf script' fixture
+    instead of a live perf.
+'''
+
+import os
+import re
+import xml.etree.ElementTree as ET
+import pytest
+
+Start = '_start;__libc_start_main@@GLIBC_2.34;__libc_start_call_main;main'
+
+# the stacks of tests/fixtures/perf.script (20 samples)
+ExpectedFolded = {
+    'emu;' + Start + ';emu_frame;z80_step': 6,
+    'emu;' + Start + ';emu_frame;z80_step;mem_rd': 3,
+    'emu;' + Start + ';emu_frame;z80_step;asm_sysvec_apic_timer_interrupt': 1,
+    'emu;' + Start + ';emu_frame;ay38910_tick': 2,
+    'emu;' + Start + ';gfx_draw;__memmove_avx_unaligned_erms': 2,
+    'emu;' + Start + ';gfx_draw;[libGLX_mesa.so.0]': 1,
+    'emu audio;start_thread;audio_thread;mix_samples': 3,
+    'emu audio;start_thread;audio_thread;[unknown]': 1,
+    'emu;native_safe_halt': 1
+}
+
+#-------------------------------------------------------------------------------
+@pytest.fixture
+def perf(load_verb) :
+    return load_verb('perf')
+
+#-------------------------------------------------------------------------------
+@pytest.fixture
+def folded(perf, fixtures_dir) :
+    with open(os.path.join(fixtures_dir, 'perf.script'), 'r') as f :
+        return perf.fold_stacks(f)
+
+#-------------------------------------------------------------------------------
+def test_fold_stacks(folded) :
+    assert folded == ExpectedFolded
+
+#-------------------------------------------------------------------------------
+def test_write_folded(perf, folded, tmp_path) :
+    path = str(tmp_path / 'out.folded')
+    perf.write_folded(path, folded)
+    with open(path, 'r') as f :
+        lines = f.read().splitlines()
+    assert lines == sorted('{} {}'.format(stack, count) for stack, count in ExpectedFolded.items())
+
+#-------------------------------------------------------------------------------
+def test_print_top_symbols(perf, folded, capsys) :
+    perf.print_top_symbols(folded, 3)
+    rows = [ line.split() for line in capsys.readouterr().out.splitlines() ]
+    # header, 3 symbols by self samples, total
+    assert rows[0] == [ 'self', '%', 'total', '%', 'symbol' ]
+    assert rows[1] == [ '6', '30.00%', '10', '50.00%', 'z80_step' ]
+    assert sorted(row[-1] for row in rows[2:4]) == [ 'mem_rd', 'mix_samples' ]
+    assert [ row[:4] for row in rows[2:4] ] == [ [ '3', '15.00%', '3', '15.00%' ] ] * 2
+    assert rows[4] == [ '20', 'samples' ]
+
+#-------------------------------------------------------------------------------
+def test_write_flamegraph(perf, folded, tmp_path) :
+    path = str(tmp_path / 'out.svg')
+    perf.write_flamegraph(path, folded, 'emu <release>')
+    # must be well-formed XML
+    svg = ET.parse(path).getroot()
+    ns = { 'svg': 'http://www.w3.org/2000/svg' }
+    assert svg.tag == '{http://www.w3.org/2000/svg}svg'
+    frames = []
+    for g in svg.findall('svg:g', ns) :
+        title = g.find('svg:title', ns).text
+        rect = g.find('svg:rect', ns)
+        name, samples = re.match(r'^(.*) \(([\d,]+) samples, [\d.]+%\)$', title).groups()
+        frames.append([ name, int(samples.replace(',', '')), float(rect.get('x')), float(rect.get('width')) ])
+    # one frame per node of the merged stacks
+    tree = perf.build_tree(folded)
+    def count_nodes(node) :
+        return 1 + sum(count_nodes(child) for child in node['children'].values())
+    assert len(frames) == count_nodes(tree)
+
+    # frame widths are proportional to the sample counts
+    root = [ frame for frame in frames if frame[0] == 'all' ][0]
+    assert root[1] == 20
+    assert root[3] == pytest.approx(perf.SvgWidth - 20, abs=0.1)
+    for name, samples, x, width in frames :
+        assert width == pytest.approx(root[3] * samples / root[1], abs=0.1)
+        assert x >= root[2] - 0.1 and x + width <= root[2] + root[3] + 0.1
+    z80_step = [ frame for frame in frames if frame[0] == 'z80_step' ][0]
+    assert z80_step[1] == 10